@@ -13,16 +13,33 @@
 #define P6us 1
 #define P11ms 5
 
+// binary protocol, see Protocol.py
+// version 3 takes 64 byte flash writes for parts with a 64 byte write buffer,
+// version 4 adds V, a write answered with the CRC of what reads back,
+// version 5 adds F, a W or V with run-length encoded data,
+// version 6 adds B, several configuration bytes in one frame,
+// version 7 sends the commands with the top bit set, see OPCODE
+#define PROTOCOL_VERSION 7
+#define REQUEST_SYNC 0xA5
+// a binary command byte: its letter with the top bit set, so a frame that
+// lost its sync byte never starts an ASCII command
+#define OPCODE(command) ((command) | 0x80)
+#define REPLY_SYNC 0x5A
+#ifndef SERIAL_RX_BUFFER_SIZE
+#define SERIAL_RX_BUFFER_SIZE 64
+#endif
+
 String inputString = "";
 boolean stringComplete = false;
 
 unsigned long temp;
 
-byte buffer[32];
+byte buffer[64];
 byte address[3];
 
 void setup() {
     Serial.begin(2000000);
+    Serial.setTimeout(100);
     pinMode(PGC, OUTPUT);
     pinMode(PGD, OUTPUT);
     pinMode(PGM, OUTPUT);
@@ -46,6 +63,11 @@ void loop() {
 //////////////////////////////
 void mainFunction() {
 
+    if (inputString.length() == 0 && Serial.peek() == REQUEST_SYNC) {
+        binaryFunction();
+        return;
+    }
+
     while (Serial.available()) {
 
         char inChar = (char) Serial.read();
@@ -59,6 +81,13 @@ void mainFunction() {
 
     }
 
+    // drop garbage before it touches the part, e.g. the rest of a binary
+    // frame that lost its sync byte
+    if (stringComplete && !validCommand()) {
+        nullString();
+        return;
+    }
+
     if (stringComplete && inputString.charAt(0) == 'W') { //WRITE
 
         int offset;
@@ -110,28 +139,7 @@ void mainFunction() {
         //Serial.println("");
 
         ///Write
-
-        digitalWrite(PGM, HIGH);
-        digitalWrite(MCLR, HIGH);
-
-        delay(1);
-
-        if (address[2] == 0x00) {
-            programBuffer(address[2], address[1], address[0]);
-        } else if (address[2] == 0xf0) {
-            // EEPROM Data
-            for(int i=0;i<data;i++) {
-                if (buffer[i] != 0xFF) { // Speedup, eeprom is erased, only write if bits change
-                    eepromWrite(address[1],address[0]+i, buffer[i]);
-                }
-            }
-        } else if (address[2] == 0x20) {
-            // ID
-            idBuffer();
-        }
-
-        digitalWrite(PGM, LOW);
-        digitalWrite(MCLR, LOW);
+        writeBuffer(data);
 
         Serial.print("K");
     }
@@ -165,39 +173,16 @@ void mainFunction() {
         Serial.print("K");
         //read
         Serial.print("R");
-        temp = 0;
 
-        temp = ((long) address[2]) << (16); //doesn't work with out (long)
-        temp |= ((long) address[1]) << (8);
-        temp |= (long) address[0];
-        
         serialPrintHex(address[2]);
         serialPrintHex(address[1]);
         serialPrintHex(address[0]);
 
-        digitalWrite(PGM, HIGH);
-        digitalWrite(MCLR, HIGH);
-        delay(1);
-
+        readBuffer(32);
         for (int i = 0; i < 32; i++) {
-            address[2] = byte((temp & 0xFF0000) >> 16);
-            address[1] = byte((temp & 0xFF00) >> 8);
-            address[0] = byte(temp & 0xFF);
-            
-            byte r;
-            if (address[2] == 0xf0) {
-                r = readEEPROM(address[1], address[0]);
-            } else {
-                r = readFlash(address[2], address[1], address[0]);
-            }
-            serialPrintHex(r);
-            
-            temp++;
+            serialPrintHex(buffer[i]);
         }
 
-
-        digitalWrite(PGM, LOW);
-        digitalWrite(MCLR, LOW);
         nullString();
         Serial.println("X");
 
@@ -206,8 +191,13 @@ void mainFunction() {
     // Say hello
     if (stringComplete && inputString.charAt(0) == 'H') {
         delay(1);
-        nullString();
         Serial.print("H");
+        if (inputString.charAt(1) == 'B') { // host knows the binary protocol
+            Serial.print("B");
+            Serial.write(PROTOCOL_VERSION);
+            Serial.write(SERIAL_RX_BUFFER_SIZE);
+        }
+        nullString();
     }
 
     if (stringComplete && inputString.charAt(0) == 'C') { //config
@@ -250,10 +240,291 @@ void mainFunction() {
 
 }
 
+// a complete ASCII command of the exact length with nothing but hex digits
+// after its letter
+boolean validCommand() {
+    unsigned int length = inputString.length();
+    switch (inputString.charAt(0)) {
+    case 'W':
+        if (length != 69 && length != 71 && length != 23)
+            return false;
+        break;
+    case 'R':
+        if (length != 7)
+            return false;
+        break;
+    case 'C':
+        if (length != 4)
+            return false;
+        break;
+    case 'E':
+    case 'D':
+        return length == 1;
+    case 'H':
+        return length == 1 || (length == 2 && inputString.charAt(1) == 'B');
+    default:
+        return false;
+    }
+    for (unsigned int i = 1; i < length; i++) {
+        char c = inputString.charAt(i);
+        if ((c < '0' || c > '9') && (c < 'A' || c > 'F'))
+            return false;
+    }
+    return true;
+}
+
+// one binary frame, the sync byte is still in the serial buffer
+void binaryFunction() {
+    byte header[6]; // command, seq, length, address MSB first
+    byte crc[2];
+
+    Serial.read();
+    if (Serial.readBytes(header, 6) != 6) {
+        return;
+    }
+
+    byte seq = header[1];
+    byte length = header[2];
+    if (length > sizeof(buffer)) {
+        binaryReject(seq);
+        return;
+    }
+
+    nullBuffer();
+    if (Serial.readBytes(buffer, length) != length || Serial.readBytes(crc, 2) != 2) {
+        binaryReject(seq);
+        return;
+    }
+    if (crc16(crc16(0xFFFF, header, 6), buffer, length) != (uint16_t) ((crc[0] << 8) | crc[1])) {
+        binaryReject(seq);
+        return;
+    }
+
+    address[2] = header[3];
+    address[1] = header[4];
+    address[0] = header[5];
+
+    switch (header[0]) {
+    case OPCODE('W'):
+    case OPCODE('V'):
+        writeReply(header[0], seq, length);
+        break;
+    case OPCODE('F'): { // W or V, the payload is the command and count, value pairs
+        byte packed[sizeof(buffer)];
+        byte data = 0;
+        memcpy(packed, buffer, length);
+        if ((length & 1) == 0 || (packed[0] != OPCODE('W') && packed[0] != OPCODE('V'))) {
+            binaryReject(seq);
+            return;
+        }
+        nullBuffer();
+        for (byte i = 1; i < length; i += 2) {
+            if (packed[i] > sizeof(buffer) - data) {
+                binaryReject(seq);
+                return;
+            }
+            memset(buffer + data, packed[i + 1], packed[i]);
+            data += packed[i];
+        }
+        if (data == 0) {
+            binaryReject(seq);
+            return;
+        }
+        writeReply(packed[0], seq, data);
+        break;
+    }
+    case OPCODE('R'):
+        length = buffer[0];
+        if (length > sizeof(buffer)) {
+            binaryReject(seq);
+            return;
+        }
+        readBuffer(length);
+        sendReply('K', seq, length);
+        break;
+    case OPCODE('C'):
+        digitalWrite(PGM, HIGH);
+        digitalWrite(MCLR, HIGH);
+        delay(1);
+
+        configWrite(address[0], buffer[0]);
+
+        digitalWrite(PGM, LOW);
+        digitalWrite(MCLR, LOW);
+        sendReply('K', seq, 0);
+        break;
+    case OPCODE('B'): // index, value pairs, programming mode is entered once
+        if (length == 0 || (length & 1) != 0) {
+            binaryReject(seq);
+            return;
+        }
+        digitalWrite(PGM, HIGH);
+        digitalWrite(MCLR, HIGH);
+        delay(1);
+
+        for (byte i = 0; i < length; i += 2) {
+            configWrite(buffer[i], buffer[i + 1]);
+        }
+
+        digitalWrite(PGM, LOW);
+        digitalWrite(MCLR, LOW);
+        sendReply('K', seq, 0);
+        break;
+    case OPCODE('S'): { // CRC of a region, length in the payload
+        if (length != 3) {
+            binaryReject(seq);
+            return;
+        }
+        unsigned long count = ((unsigned long) buffer[0] << 16)
+                | ((unsigned long) buffer[1] << 8) | buffer[2];
+        uint16_t crc = regionCRC(count);
+        buffer[0] = byte(crc >> 8);
+        buffer[1] = byte(crc & 0xFF);
+        sendReply('K', seq, 2);
+        break;
+    }
+    default:
+        binaryReject(seq);
+    }
+}
+
+// program length bytes of buffer; V answers with the CRC of the bytes just
+// written as they read back
+void writeReply(byte command, byte seq, byte length) {
+    writeBuffer(length);
+    if (command == OPCODE('V')) {
+        uint16_t crc = regionCRC(length);
+        buffer[0] = byte(crc >> 8);
+        buffer[1] = byte(crc & 0xFF);
+        sendReply('K', seq, 2);
+    } else {
+        sendReply('K', seq, 0);
+    }
+}
+
+// drop the rest of a broken frame and tell the host to resend it
+void binaryReject(byte seq) {
+    while (Serial.available()) {
+        Serial.read();
+    }
+    sendReply('N', seq, 0);
+}
+
+void sendReply(byte status, byte seq, byte length) {
+    byte header[3] = { status, seq, length };
+    uint16_t crc = crc16(crc16(0xFFFF, header, 3), buffer, length);
+
+    Serial.write(REPLY_SYNC);
+    Serial.write(header, 3);
+    Serial.write(buffer, length);
+    Serial.write(byte(crc >> 8));
+    Serial.write(byte(crc & 0xFF));
+}
+
+// CRC-16/CCITT, polynomial 0x1021
+uint16_t crc16(uint16_t crc, byte *data, byte length) {
+    for (byte i = 0; i < length; i++) {
+        crc ^= (uint16_t) data[i] << 8;
+        for (byte j = 0; j < 8; j++) {
+            if (crc & 0x8000)
+                crc = (crc << 1) ^ 0x1021;
+            else
+                crc <<= 1;
+        }
+    }
+    return crc;
+}
+
+// program data bytes of buffer at address
+void writeBuffer(byte data) {
+    digitalWrite(PGM, HIGH);
+    digitalWrite(MCLR, HIGH);
+
+    delay(1);
+
+    if (address[2] == 0x00) {
+        // shorter writes are padded with 0xFF by nullBuffer
+        programBuffer(address[2], address[1], address[0], data > 32 ? 64 : 32);
+    } else if (address[2] == 0xf0) {
+        // EEPROM Data
+        for(int i=0;i<data;i++) {
+            if (buffer[i] != 0xFF) { // Speedup, eeprom is erased, only write if bits change
+                eepromWrite(address[1],address[0]+i, buffer[i]);
+            }
+        }
+    } else if (address[2] == 0x20) {
+        // ID
+        idBuffer();
+    }
+
+    digitalWrite(PGM, LOW);
+    digitalWrite(MCLR, LOW);
+}
+
+// next byte of a sequential read starting at address
+byte readNext() {
+    byte value;
+    if (address[2] == 0xf0) {
+        value = readEEPROM(byte((temp & 0xFF00) >> 8), byte(temp & 0xFF));
+    } else {
+        value = readFlashNext();
+    }
+    temp++;
+    return value;
+}
+
+void startRead() {
+    temp = ((long) address[2]) << (16); //doesn't work with out (long)
+    temp |= ((long) address[1]) << (8);
+    temp |= (long) address[0];
+
+    digitalWrite(PGM, HIGH);
+    digitalWrite(MCLR, HIGH);
+    delay(1);
+
+    if (address[2] != 0xf0) {
+        setTablePointer(address[2], address[1], address[0]);
+    }
+}
+
+// read count bytes starting at address into buffer
+void readBuffer(byte count) {
+    startRead();
+    for (byte i = 0; i < count; i++) {
+        buffer[i] = readNext();
+    }
+
+    digitalWrite(PGM, LOW);
+    digitalWrite(MCLR, LOW);
+}
+
+// CRC of count bytes starting at address, nothing is sent while reading
+uint16_t regionCRC(unsigned long count) {
+    uint16_t crc = 0xFFFF;
+    startRead();
+    for (unsigned long i = 0; i < count; i++) {
+        byte value = readNext();
+        crc = crc16(crc, &value, 1);
+    }
+
+    digitalWrite(PGM, LOW);
+    digitalWrite(MCLR, LOW);
+    return crc;
+}
+
 byte readFlash(byte usb, byte msb, byte lsb) {
+    setTablePointer(usb, msb, lsb);
+    send4bitcommand (B1000); //
+    return shiftInTable();
+}
 
-    byte value = 0;
+// table read with post-increment, the pointer only has to be set once per block
+byte readFlashNext() {
+    send4bitcommand (B1001);
+    return shiftInTable();
+}
 
+void setTablePointer(byte usb, byte msb, byte lsb) {
     send4bitcommand (B0000);
     send16bit(0x0e00 | usb); //
     send4bitcommand(B0000);
@@ -268,8 +539,11 @@ byte readFlash(byte usb, byte msb, byte lsb) {
     send16bit(0x0e00 | lsb); //
     send4bitcommand(B0000);
     send16bit(0x6ef6);
+}
 
-    send4bitcommand (B1000); //
+byte shiftInTable() {
+
+    byte value = 0;
 
     pinMode(PGD, INPUT);
     digitalWrite(PGD, LOW);
@@ -683,9 +957,10 @@ void idBuffer() {
 
 }
 
-void programBuffer(byte usb, byte msb, byte lsb) {
+void programBuffer(byte usb, byte msb, byte lsb, byte count) {
 
-    if ((lsb & 0x0F) | ((lsb & 0xF0) >> 4) % 2) {
+    // count is the write buffer size of the part, 32 or 64 bytes
+    if ((count != 32 && count != 64) || (lsb & (count - 1))) {
         //Serial.println("Error: First digit (refere as HEX) have to be 0, and the second digit have to be even.");
         //Serial.println("valid examples: 0x000000 , 0x000060, 0x006320, 0x0063E0");
         //Serial.println("INvalid examples: 0x000004 , 0x000014, 0x006328, 0x0063EA");
@@ -716,14 +991,14 @@ void programBuffer(byte usb, byte msb, byte lsb) {
     send16bit(0x6ef6);
 
     //step 3
-    for (byte i = 0; i < 15; i++) {
+    for (byte i = 0; i < count / 2 - 1; i++) {
         send4bitcommand (B1101);
         send16bit(buffer[(2 * i) + 1] << 8 | buffer[(i * 2)]);
     }
 
     //step 4
     send4bitcommand (B1111);
-    send16bit(buffer[31] << 8 | buffer[30]);
+    send16bit(buffer[count - 1] << 8 | buffer[count - 2]);
 
     //nop
     digitalWrite(PGC, HIGH);
@@ -755,7 +1030,7 @@ void nullString() {
 }
 
 void nullBuffer() {
-    for (byte i = 0; i < 32; i++)
+    for (byte i = 0; i < sizeof(buffer); i++)
         buffer[i] = 0xFF;
 }
 
@@ -0,0 +1,387 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Session daemon keeping the serial port open between jobs. Opening the port
+# resets the Arduino, which costs 2 seconds before every handshake; the daemon
+# pays it once and after that only when the connection got lost.
+#
+# Clients talk newline delimited JSON over a Unix socket or a TCP port on the
+# loopback interface. A request is one object
+#   {"command": "program", "hex": "<hex file text>", "mcu": "", "window": 4,
+#    "skipUnchanged": false, "verbose": false, "extraVerbose": false, "interleave": false,
+#    "metrics": false}
+# with command one of program, erase, deviceid, verify, dump or shutdown; dump
+# takes "binary": true for the raw flash instead of Intel HEX. Jobs run
+# one after the other in the order they arrived. The daemon answers with one
+# {"line": "..."} per line of output, {"metrics": <report>} if asked for,
+# {"dump": "<file contents, base64>"} for a dump and finally
+# {"result": <exit code>}.
+#
+# Any client that reaches the socket can erase and program the chip, so TCP
+# listens on the loopback interface only unless --remote is given.
+#
+#   ./Daemon.py -P /dev/ttyACM0 &
+#   ./pic_programmer.py -S -i blink.hex
+
+import base64
+import getopt
+import io
+import ipaddress
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+from serial import *
+from Hex import HexError
+from Plan import loadPlan
+from Protocol import ProtocolError, REPLY_TIMEOUT
+from Metrics import Metrics, saveReport
+import pic_programmer as programmer
+
+DEFAULT_ADDRESS = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+                               'pic_programmer.sock')
+
+COMMANDS = ('program', 'erase', 'deviceid', 'verify', 'dump', 'shutdown')
+
+
+def parseAddress(address):
+    # host:port or a bare port number is TCP, anything else a Unix socket path
+    if address.isdigit():
+        return ('127.0.0.1', int(address))
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return (host or '127.0.0.1', int(port))
+    return address
+
+
+def isLoopback(address):
+    # a Unix socket, or a TCP address only this host can connect to
+    if not isinstance(address, tuple):
+        return True
+    try:
+        infos = socket.getaddrinfo(address[0], address[1], proto=socket.IPPROTO_TCP)
+    except OSError:
+        return False
+    return all(ipaddress.ip_address(info[4][0].split('%')[0]).is_loopback for info in infos)
+
+
+class Session:
+    # one Arduino, connected on the first job and kept open afterwards
+    def __init__(self, port, asciiMode=False, noReset=False, timeout=REPLY_TIMEOUT):
+        self.port = port
+        self.asciiMode = asciiMode
+        self.noReset = noReset
+        self.timeout = timeout
+        self.arduino = None
+        self.link = None
+        self.metrics = Metrics()
+        self.dump = None
+
+    def open(self):
+        print("Connecting to arduino...", end = '')
+        try:
+            with self.metrics.phase("open port"):
+                self.arduino = programmer.openArduino(self.port, self.noReset, self.metrics)
+        except (SerialException, OSError) as msg:
+            print(msg)
+            return False
+        with self.metrics.phase("connect"):
+            self.link = programmer.connect(self.arduino, self.asciiMode, metrics=self.metrics,
+                                           timeout=self.timeout)
+        if self.link is None:
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        if self.arduino is not None:
+            try:
+                self.arduino.close()
+            except (SerialException, OSError):
+                pass
+        self.arduino = None
+        self.link = None
+
+    def run(self, job):
+        # a job that loses the port reconnects and starts over once;
+        # self.metrics covers the last job, self.dump holds the file it read
+        self.metrics = Metrics()
+        self.dump = None
+        if self.arduino is not None:
+            self.arduino.metrics = self.metrics
+            self.link.metrics = self.metrics
+        for attempt in range(2):
+            if self.arduino is None and not self.open():
+                return 2
+            try:
+                return self.execute(job)
+            except (SerialException, OSError) as msg:
+                print("connection lost; " + str(msg))
+                self.close()
+            except ProtocolError as msg:
+                # the firmware may be stuck in the middle of a frame, reset it next time
+                print("abort; " + str(msg))
+                self.close()
+                return 1
+        return 2
+
+    def execute(self, job):
+        command = job['command']
+        verbose = bool(job.get('verbose', False))
+        extraVerbose = bool(job.get('extraVerbose', False))
+        mcu = job.get('mcu', "")
+        self.link.verbose = verbose
+
+        if command == 'deviceid':
+            return 0 if programmer.findDevice(self.link) is not None else 1
+        if command == 'erase':
+            return programmer.flashConnected(self.link, self.port, None, mcu, eraseMode=True)
+        if command == 'dump':
+            # the file goes back to the client, which writes it
+            binary = bool(job.get('binary', False))
+            output = io.BytesIO() if binary else io.StringIO()
+            result = programmer.dumpConnected(self.link, "", mcu, output, binary)
+            if result == 0:
+                data = output.getvalue()
+                self.dump = data if binary else data.encode('ascii')
+            return result
+
+        try:
+            hexFile = loadPlan(job.get('hex', "").encode('utf-8'), programmer.planLayout)
+        except HexError as msg:
+            print("Hex file not valid: " + str(msg))
+            return 2
+
+        if command == 'verify':
+            device = programmer.findDevice(self.link, mcu)
+            if device is None:
+                return 1
+            error = hexFile.fits(device)
+            if error is not None:
+                print("Hex file does not fit the " + device.name + ": " + error)
+                return 1
+            return 0 if programmer.verifyImage(self.link, hexFile, verbose, device=device) else 1
+        return programmer.flashConnected(self.link, self.port, hexFile, mcu,
+                                         window=int(job.get('window', programmer.DEFAULT_WINDOW)),
+                                         skipUnchanged=bool(job.get('skipUnchanged', False)),
+                                         verbose=verbose, extraVerbose=extraVerbose,
+                                         interleave=bool(job.get('interleave', False)))
+
+
+class Daemon:
+    # accepts jobs from any number of clients, a single worker runs them in order;
+    # remote allows a TCP address other hosts can reach
+    def __init__(self, session, address=DEFAULT_ADDRESS, remote=False):
+        self.session = session
+        self.address = parseAddress(address)
+        if not remote and not isLoopback(self.address):
+            raise ValueError(address + " can be reached from other hosts, which could erase and"
+                             " program the chip; --remote allows it")
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.output = programmer.ThreadOutput(sys.stdout)
+        self.server = None
+
+    def worker(self):
+        while True:
+            job, replies = self.jobs.get()
+            if job is None:
+                break
+            self.output.start(lambda line: replies.put({'line': line}))
+            try:
+                result = self.session.run(job)
+            except Exception as msg:
+                print("abort; " + str(msg))
+                result = 1
+            finally:
+                self.output.finish()
+            with self.lock:
+                self.queued -= 1
+            if job.get('metrics'):
+                replies.put({'metrics': self.session.metrics.finish()})
+            if self.session.dump is not None:
+                replies.put({'dump': base64.b64encode(self.session.dump).decode('ascii')})
+            replies.put({'result': result})
+
+    def handle(self, request, send):
+        try:
+            job = json.loads(request)
+        except ValueError:
+            job = None
+        if not isinstance(job, dict) or job.get('command') not in COMMANDS:
+            send({'line': "unknown request, expected one of " + ", ".join(COMMANDS)})
+            send({'result': 2})
+            return
+        if job['command'] == 'shutdown':
+            send({'result': 0})
+            threading.Thread(target=self.server.shutdown).start()
+            return
+
+        replies = queue.Queue()
+        with self.lock:
+            ahead = self.queued
+            self.queued += 1
+            self.jobs.put((job, replies))
+        if ahead:
+            send({'line': "queued, " + str(ahead) + " job(s) ahead"})
+        while True:
+            reply = replies.get()
+            try:
+                send(reply)
+            except OSError:
+                # the client went away, the job still runs to the end
+                send = lambda reply: None
+            if 'result' in reply:
+                break
+
+    def serve(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                def send(reply):
+                    self.wfile.write((json.dumps(reply) + "\n").encode('utf-8'))
+                    self.wfile.flush()
+                daemon.handle(self.rfile.readline().decode('utf-8'), send)
+
+        if isinstance(self.address, tuple):
+            socketserver.ThreadingTCPServer.allow_reuse_address = True
+            self.server = socketserver.ThreadingTCPServer(self.address, Handler)
+            name = "%s:%d" % self.address
+        else:
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            self.server = socketserver.ThreadingUnixStreamServer(self.address, Handler)
+            name = self.address
+        self.server.daemon_threads = True
+
+        worker = threading.Thread(target=self.worker, daemon=True)
+        worker.start()
+        stdout = sys.stdout
+        sys.stdout = self.output
+        stdout.write("Serving " + self.session.port + " on " + name + "\n")
+        stdout.flush()
+        try:
+            self.server.serve_forever()
+        finally:
+            sys.stdout = stdout
+            self.jobs.put((None, None))
+            worker.join()
+            self.server.server_close()
+            if not isinstance(self.address, tuple):
+                os.unlink(self.address)
+            self.session.close()
+
+
+def submit(job, address=DEFAULT_ADDRESS, metricsJson="", dumpFile="", output=None):
+    # client side: hand the job to the daemon, print its output and return
+    # the exit code of the job; a metrics report is saved to metricsJson, a
+    # dump to dumpFile or, as text, to output
+    address = parseAddress(address)
+    family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+    try:
+        connection = socket.socket(family, socket.SOCK_STREAM)
+        connection.connect(address)
+    except OSError as msg:
+        print("No session daemon at " + str(address) + ": " + str(msg))
+        return 2
+
+    with connection, connection.makefile('rwb') as stream:
+        stream.write((json.dumps(job) + "\n").encode('utf-8'))
+        stream.flush()
+        for line in stream:
+            reply = json.loads(line.decode('utf-8'))
+            if 'line' in reply:
+                print(reply['line'])
+            if 'metrics' in reply and metricsJson:
+                saveReport(reply['metrics'], metricsJson)
+            if 'dump' in reply:
+                data = base64.b64decode(reply['dump'])
+                try:
+                    if output is not None:
+                        output.write(data.decode('ascii'))
+                    else:
+                        with open(dumpFile, 'wb') as f:
+                            f.write(data)
+                except OSError as msg:
+                    print("Can not write the dump: " + str(msg))
+                    return 2
+            if 'result' in reply:
+                return reply['result']
+    print("Session daemon closed the connection")
+    return 2
+
+
+def main():
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], 'hP:L:an', ['help', 'port=', 'listen=',
+                                                                    'ascii', 'no-reset',
+                                                                    'timeout=', 'remote'])
+    except getopt.GetoptError as msg:
+        print(msg)
+        sys.exit(2)
+
+    port = '/dev/ttyACM0'
+    address = DEFAULT_ADDRESS
+    asciiMode = False
+    noReset = False
+    timeout = REPLY_TIMEOUT
+    remote = False
+    for opt, arg in options:
+        if opt in ('-h', '--help'):
+            print("usage: Daemon.py [-P port] [-L socket path, port or host:port] [-a] [-n]"
+                  " [--timeout seconds] [--remote]")
+            sys.exit(0)
+        elif opt in ('-P', '--port'):
+            port = arg
+        elif opt in ('-L', '--listen'):
+            address = arg
+        elif opt in ('-a', '--ascii'):
+            asciiMode = True
+        elif opt in ('-n', '--no-reset'):
+            noReset = True
+        elif opt == '--timeout':
+            try:
+                timeout = float(arg)
+            except ValueError:
+                timeout = 0
+            if timeout <= 0:
+                print("The timeout needs to be a positive number of seconds")
+                sys.exit(2)
+        elif opt == '--remote':
+            remote = True
+
+    try:
+        daemon = Daemon(Session(port, asciiMode, noReset, timeout), address, remote)
+    except ValueError as msg:
+        print(msg)
+        sys.exit(2)
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Supported parts and their memory geometry, from the programming
+# specification 39622L and the data sheets of each family.
+#
+#   deviceID      DEVID2:DEVID1 with the revision bits cleared
+#   flashSize     program memory in bytes
+#   eepromSize    data EEPROM in bytes, 0 if the part has none
+#   writeBlock    size of the write buffer, one programming cycle
+#   eraseBlock    size of a row erase
+#   configMasks   implemented bits of CONFIG1L (0x300000) to CONFIG7H (0x30000D)
+
+from collections import namedtuple
+
+Device = namedtuple('Device', 'name deviceID flashSize eepromSize writeBlock eraseBlock configMasks')
+
+# PIC18F2455/2550/4455/4550, 39632
+USB_28 = bytes([0x3F, 0xCF, 0x3F, 0x1F, 0x00, 0x87, 0xC5, 0x00,
+                0x0F, 0xC0, 0x0F, 0xE0, 0x0F, 0x40])
+USB_40 = bytes([0x3F, 0xCF, 0x3F, 0x1F, 0x00, 0x87, 0xE5, 0x00,
+                0x0F, 0xC0, 0x0F, 0xE0, 0x0F, 0x40])
+
+# PIC18F2420/2520/4420/4520, 39631, and PIC18F2525/2620/4525/4620, 39626;
+# the code protection bits depend on the number of flash blocks
+BASIC_16K = bytes([0x00, 0xCF, 0x1F, 0x1F, 0x00, 0x87, 0xC5, 0x00,
+                   0x03, 0xC0, 0x03, 0xE0, 0x03, 0x40])
+BASIC_24K = bytes([0x00, 0xCF, 0x1F, 0x1F, 0x00, 0x87, 0xC5, 0x00,
+                   0x07, 0xC0, 0x07, 0xE0, 0x07, 0x40])
+BASIC_32K = bytes([0x00, 0xCF, 0x1F, 0x1F, 0x00, 0x87, 0xC5, 0x00,
+                   0x0F, 0xC0, 0x0F, 0xE0, 0x0F, 0x40])
+
+DEVICES = (
+    Device("18f2455", 0x1260, 0x6000, 0x100, 0x20, 0x40, USB_28[:8] + BASIC_24K[8:]),
+    Device("18f2550", 0x1240, 0x8000, 0x100, 0x20, 0x40, USB_28),
+    Device("18f4455", 0x1202, 0x6000, 0x100, 0x20, 0x40, USB_40[:8] + BASIC_24K[8:]),
+    Device("18f4550", 0x1200, 0x8000, 0x100, 0x20, 0x40, USB_40),
+    Device("18f2420", 0x1140, 0x4000, 0x100, 0x20, 0x40, BASIC_16K),
+    Device("18f2520", 0x1100, 0x8000, 0x100, 0x20, 0x40, BASIC_32K),
+    Device("18f4420", 0x10C0, 0x4000, 0x100, 0x20, 0x40, BASIC_16K),
+    Device("18f4520", 0x1080, 0x8000, 0x100, 0x20, 0x40, BASIC_32K),
+    Device("18f2525", 0x0CC0, 0xC000, 0x400, 0x40, 0x40, BASIC_24K),
+    Device("18f2620", 0x0C80, 0x10000, 0x400, 0x40, 0x40, BASIC_32K),
+    Device("18f4525", 0x0C40, 0xC000, 0x400, 0x40, 0x40, BASIC_24K),
+    Device("18f4620", 0x0C00, 0x10000, 0x400, 0x40, 0x40, BASIC_32K),
+)
+
+# the part assumed when none is known yet, e.g. by the benchmarks
+DEFAULT_DEVICE = DEVICES[3]
+
+# a hex file parsed before the part is known has to fit the largest one
+MAX_FLASH_SIZE = max(device.flashSize for device in DEVICES)
+MAX_EEPROM_SIZE = max(device.eepromSize for device in DEVICES)
+
+
+def byName(name):
+    # accepts 18f4550 and pic18f4550 in any case, None if unknown
+    name = name.lower().replace("pic", "")
+    for device in DEVICES:
+        if device.name == name:
+            return device
+    return None
+
+
+def byID(deviceID):
+    for device in DEVICES:
+        if device.deviceID == deviceID:
+            return device
+    return None
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Reading a chip back into a file, e.g. to audit returned units. Every
+# block goes to the file as soon as it arrived. Intel HEX files hold flash,
+# ID, configuration and EEPROM and leave out blank (0xFF) blocks, raw binary
+# files hold the flash up to the last block that is not blank.
+
+from Hex import BLANK, BLOCK_SIZE, ID_BASE, ID_SIZE, FUSE_BASE, FUSE_SIZE, EEPROM_BASE, \
+    DATA, EOF, EXTENDED_LINEAR
+
+RECORD_SIZE = 0x10
+
+
+def hexRecord(recordType, address, data=b''):
+    raw = bytes([len(data), (address >> 8) & 0xFF, address & 0xFF, recordType]) + bytes(data)
+    return ':' + (raw + bytes([-sum(raw) & 0xFF])).hex().upper() + '\n'
+
+
+class HexWriter:
+    # Intel HEX on a text file object, RECORD_SIZE bytes per record
+    def __init__(self, output):
+        self.output = output
+        self.segment = None
+
+    def write(self, address, data):
+        # records end on RECORD_SIZE boundaries, so none crosses a segment
+        offset = 0
+        while offset < len(data):
+            start = address + offset
+            length = min(len(data) - offset, RECORD_SIZE - start % RECORD_SIZE)
+            if start >> 16 != self.segment:
+                self.segment = start >> 16
+                self.output.write(hexRecord(EXTENDED_LINEAR, 0, self.segment.to_bytes(2, 'big')))
+            self.output.write(hexRecord(DATA, start & 0xFFFF, data[offset:offset + length]))
+            offset += length
+
+    def close(self):
+        self.output.write(hexRecord(EOF, 0))
+
+
+class BinaryWriter:
+    # the flash as a raw image on a binary file object, gaps between the
+    # blocks written are filled with 0xFF; everything else is dropped
+    def __init__(self, output):
+        self.output = output
+        self.end = 0
+
+    def write(self, address, data):
+        if address >= ID_BASE:
+            return
+        if address > self.end:
+            self.output.write(b'\xff' * (address - self.end))
+        self.output.write(data)
+        self.end = address + len(data)
+
+    def close(self):
+        pass
+
+
+def isBinary(fileName):
+    return fileName.lower().endswith('.bin')
+
+
+def dumpImage(link, device, writer, verbose=False):
+    # read every memory of the part into writer, returns the number of bytes read
+    size = link.maxRead
+    total = 0
+    for label, phase, base, length in (
+            ("Reading flash memory....", "flash read", 0, device.flashSize),
+            ("Reading ID memory.......", "ID read", ID_BASE, ID_SIZE),
+            ("Reading EEPROM memory...", "EEPROM read", EEPROM_BASE, device.eepromSize)):
+        if not length:
+            # the part has no EEPROM
+            continue
+        print(label, end = '')
+        if verbose:
+            print("\n")
+        with link.metrics.phase(phase):
+            for address in range(base, base + length, size):
+                data = link.read(address, min(size, base + length - address))
+                total += len(data)
+                for offset in range(0, len(data), BLOCK_SIZE):
+                    block = data[offset:offset + BLOCK_SIZE]
+                    if block != BLANK[:len(block)]:
+                        writer.write(address + offset, block)
+        print("\tSuccess")
+
+    # the configuration is kept even if it is blank, it tells how the part was set up
+    print("Reading configuration...", end = '')
+    with link.metrics.phase("config read"):
+        writer.write(FUSE_BASE, link.read(FUSE_BASE, FUSE_SIZE))
+    total += FUSE_SIZE
+    print("\tSuccess")
+    writer.close()
+    return total
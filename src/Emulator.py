@@ -0,0 +1,617 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Emulator of PIC18f_auto.ino with a PIC18F attached, for testing and
+# benchmarking without hardware. Emulator is a pyserial compatible object,
+# PtyBridge exposes it on a pseudo terminal that pic_programmer.py can open:
+#
+#   ./Emulator.py --mcu 18f4550 --latency 0.001
+#   ./pic_programmer.py -P /dev/pts/N -i blink.hex
+#
+# Every byte gets an arrival time from the baud rate and the injected delays,
+# the firmware consumes it when it is not busy with a command and every command
+# keeps it busy for the time listed in TIMING. Bytes that arrive while the
+# receive buffer is full are lost like on the real board.
+
+import getopt
+import os
+import random
+import select
+import sys
+import threading
+import time
+import tty
+from collections import deque
+
+from Devices import DEFAULT_DEVICE, byName
+from Protocol import REQUEST_SYNC, PROTOCOL_VERSION, ACK, NAK, crc16, binaryReply, opcode
+
+# seconds spent by the firmware, estimated for an Arduino Uno (digitalWrite ~4us)
+TIMING = {
+    'asciiChar': 0.000006,      # String append and char2byte per received character
+    'binaryByte': 0.000004,     # CRC per received byte
+    'hello': 0.001,
+    'deviceID': 0.105,
+    'erase': 0.030,
+    'flashWrite': 0.001,        # programBuffer, P9 programming time
+    'flashWord': 0.00028,       # programBuffer, per word shifted in
+    'idWrite': 0.0025,
+    'eepromWrite': 0.0045,      # per byte that is not 0xFF
+    'config': 0.0025,
+    'tablePointer': 0.0011,     # setTablePointer, once per read
+    'flashRead': 0.00022,       # per byte, table read with post-increment
+    'eepromRead': 0.0012,       # per byte
+    'crcByte': 0.00001,
+    'frameTimeout': 0.100,      # Serial.setTimeout
+}
+
+# first characters of the ASCII commands mainFunction knows, a string that
+# starts with anything else is dropped
+ASCII_COMMANDS = b'HERWCD'
+
+HEX_DIGITS = b'0123456789ABCDEF'
+
+# the lengths of the ASCII commands that carry hex digits after their letter
+ASCII_LENGTHS = {b'W': (69, 71, 23), b'R': (7,), b'C': (4,)}
+
+# the firmware version each binary command appeared in
+BINARY_COMMANDS = {'R': 1, 'C': 1, 'W': 1, 'S': 2, 'V': 4, 'F': 5, 'B': 6}
+
+
+def char2byte(text):
+    # like char2byte of the firmware: anything but an upper case hex digit,
+    # or a character past the end of the string, counts as 0
+    value = 0
+    for c in text:
+        value = value << 4 | max(HEX_DIGITS.find(c), 0)
+    return value
+
+
+def validCommand(command):
+    # like validCommand of the firmware: anything but a command of the exact
+    # length with nothing but hex digits after its letter is dropped
+    c = command[:1]
+    if c in (b'E', b'D'):
+        return len(command) == 1
+    if c == b'H':
+        return command in (b'H', b'HB')
+    if len(command) not in ASCII_LENGTHS.get(c, ()):
+        return False
+    return all(digit in HEX_DIGITS for digit in command[1:])
+
+
+class RealClock:
+    def now(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class VirtualClock:
+    # time only passes when somebody waits, results are exact and reproducible
+    def __init__(self):
+        self.time = 0.0
+
+    def now(self):
+        return self.time
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.time += seconds
+
+
+class PicMemory:
+    # configMasks are the implemented configuration bits, the others read as 0
+    def __init__(self, deviceID=DEFAULT_DEVICE.deviceID, flashSize=DEFAULT_DEVICE.flashSize,
+                 eepromSize=DEFAULT_DEVICE.eepromSize, configMasks=DEFAULT_DEVICE.configMasks):
+        self.deviceID = deviceID
+        self.flash = bytearray(b'\xff') * flashSize
+        self.id = bytearray(b'\xff') * 0x8
+        self.config = bytearray(b'\xff') * 0x10
+        self.configMasks = bytes(configMasks).ljust(0x10, b'\x00')
+        self.eeprom = bytearray(b'\xff') * eepromSize
+
+    def erase(self):
+        for region in (self.flash, self.id, self.config, self.eeprom):
+            region[:] = b'\xff' * len(region)
+
+    def programFlash(self, address, data):
+        # programming can only clear bits, unprogrammed addresses are ignored
+        for i, value in enumerate(data):
+            if address + i < len(self.flash):
+                self.flash[address + i] &= value
+
+    def programID(self, data):
+        for i in range(len(self.id)):
+            self.id[i] &= data[i]
+
+    def writeEEPROM(self, address, value):
+        self.eeprom[address % len(self.eeprom)] = value
+
+    def writeConfig(self, index, value):
+        self.config[index & 0x0F] = value
+
+    def readFlash(self, address):
+        if address < len(self.flash):
+            return self.flash[address]
+        if 0x200000 <= address < 0x200008:
+            return self.id[address - 0x200000]
+        if 0x300000 <= address < 0x300010:
+            return self.config[address - 0x300000] & self.configMasks[address - 0x300000]
+        if address == 0x3FFFFE:
+            return self.deviceID & 0xFF
+        if address == 0x3FFFFF:
+            return self.deviceID >> 8
+        return 0
+
+    def readEEPROM(self, address):
+        return self.eeprom[address % len(self.eeprom)]
+
+
+class Emulator:
+    def __init__(self, memory=None, baudrate=2000000, latency=0.0, byteDelay=0.0,
+                 dropRate=0.0, corruptRate=0.0, rxBuffer=64, binary=True,
+                 timing=None, clock=None, seed=0, bootTime=0.0, weakRate=0.0,
+                 version=PROTOCOL_VERSION):
+        self.memory = memory if memory is not None else PicMemory()
+        self.baudrate = baudrate
+        self.latency = latency          # added once per write and per reply
+        self.byteDelay = byteDelay      # added per byte on top of the baud rate
+        self.dropRate = dropRate
+        self.corruptRate = corruptRate
+        self.weakRate = weakRate        # flash and config writes that leave the memory unchanged
+        self.rxBuffer = rxBuffer
+        self.binary = binary            # answer the binary protocol handshake
+        self.version = version          # the firmware version to behave like
+        self.opcodes = {opcode(command, version): command
+                        for command, since in BINARY_COMMANDS.items() if since <= version}
+        self.timing = dict(TIMING)
+        if timing:
+            self.timing.update(timing)
+        self.clock = clock if clock is not None else RealClock()
+        self.random = random.Random(seed)
+        self.bootTime = bootTime        # the bootloader swallows input this long after a reset
+        self.bootUntil = self.clock.now() + bootTime
+
+        # pyserial attributes
+        self.port = "emulator"
+        self.timeout = None
+        self.write_timeout = None
+        self.is_open = True
+        self._dtr = True
+        self.rts = True
+
+        self.hostFree = 0.0             # when the host to arduino line is idle again
+        self.deviceFree = 0.0           # when the firmware finished its last command
+        self.drainUntil = -1.0
+        self.waiting = deque()          # consume times of bytes in the receive buffer
+        self.output = deque()           # (ready time, byte) towards the host
+
+        # firmware parser state
+        self.inputString = bytearray()
+        self.frame = None
+        self.frameTime = 0.0
+
+        self.stats = {'sent': 0, 'received': 0, 'overflow': 0, 'dropped': 0,
+                      'corrupted': 0, 'weak': 0, 'commands': {}}
+
+    def reset(self):
+        # what the auto-reset circuit does when DTR gets asserted
+        now = self.clock.now()
+        self.bootUntil = now + self.bootTime
+        self.inputString = bytearray()
+        self.frame = None
+        self.waiting.clear()
+        self.output.clear()
+        self.deviceFree = now
+
+    # pyserial interface
+
+    @property
+    def dtr(self):
+        return self._dtr
+
+    @dtr.setter
+    def dtr(self, value):
+        if value and not self._dtr:
+            self.reset()
+        self._dtr = value
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        self.output.clear()
+
+    reset_input_buffer = flushInput
+
+    def flushOutput(self):
+        pass
+
+    reset_output_buffer = flushOutput
+
+    @property
+    def in_waiting(self):
+        now = self.clock.now()
+        self.expire(now)
+        return sum(1 for ready, _ in self.output if ready <= now)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    @property
+    def out_waiting(self):
+        return 0
+
+    def write(self, data):
+        data = bytes(data)
+        now = self.clock.now()
+        self.stats['sent'] += len(data)
+        byteTime = 10.0 / self.baudrate + self.byteDelay
+        arrival = max(now + self.latency, self.hostFree)
+        for value in data:
+            arrival += byteTime
+            value = self.damage(value)
+            if value is not None:
+                self.receive(arrival, value)
+        self.hostFree = arrival
+        return len(data)
+
+    def read(self, size=1):
+        # returns once size bytes are ready or the timeout passed; without a
+        # timeout a read that could never complete returns early instead of hanging
+        now = self.clock.now()
+        deadline = None if self.timeout is None else now + self.timeout
+        self.expire(deadline if deadline is not None else float('inf'))
+
+        if len(self.output) >= size:
+            ready = self.output[size - 1][0]
+        elif deadline is not None:
+            ready = deadline
+        elif self.output:
+            ready = self.output[-1][0]
+        else:
+            ready = now
+        if deadline is not None and ready > deadline:
+            ready = deadline
+        self.clock.sleep(ready - now)
+
+        data = bytearray()
+        while self.output and len(data) < size and self.output[0][0] <= ready:
+            data.append(self.output.popleft()[1])
+        self.stats['received'] += len(data)
+        return bytes(data)
+
+    # wire
+
+    def damage(self, value):
+        if self.dropRate and self.random.random() < self.dropRate:
+            self.stats['dropped'] += 1
+            return None
+        if self.corruptRate and self.random.random() < self.corruptRate:
+            self.stats['corrupted'] += 1
+            return value ^ (1 << self.random.randrange(8))
+        return value
+
+    def reply(self, when, data):
+        byteTime = 10.0 / self.baudrate + self.byteDelay
+        when = max(when, self.output[-1][0] if self.output else 0.0) + self.latency
+        for value in data:
+            when += byteTime
+            value = self.damage(value)
+            if value is not None:
+                self.output.append((when, value))
+
+    def receive(self, arrival, value):
+        # the firmware reads a byte once it is done with the current command
+        self.expire(arrival)
+        while self.waiting and self.waiting[0] <= arrival:
+            self.waiting.popleft()
+        if len(self.waiting) >= self.rxBuffer:
+            self.stats['overflow'] += 1
+            return
+        if arrival <= self.drainUntil or arrival < self.bootUntil:
+            return
+        queued = arrival <= self.deviceFree
+        consumed = max(arrival, self.deviceFree)
+        self.waiting.append(consumed)
+        self.deviceFree = consumed
+        self.consume(consumed, value, queued)
+
+    def busy(self, when, command, seconds):
+        self.stats['commands'][command] = self.stats['commands'].get(command, 0) + 1
+        self.deviceFree = when + seconds
+        return self.deviceFree
+
+    # firmware
+
+    def expire(self, now):
+        # Serial.readBytes gave up on a binary frame
+        if self.frame is not None and now > self.frameTime + self.timing['frameTimeout']:
+            timedOut = self.frameTime + self.timing['frameTimeout']
+            frame, self.frame = self.frame, None
+            if len(frame) >= 7:
+                self.reject(timedOut, frame[2])
+
+    def consume(self, when, value, queued=True):
+        # queued: the byte was waiting when the firmware finished the previous
+        # one, mainFunction reads it in the same call
+        if self.frame is not None:
+            self.frameTime = when
+            self.frame.append(value)
+            self.deviceFree = when + self.timing['binaryByte']
+            self.binaryFunction(when)
+            return
+        if self.inputString and self.inputString[0] not in ASCII_COMMANDS and not queued:
+            # mainFunction cleared the string when the receive buffer ran empty
+            self.inputString = bytearray()
+        if not self.inputString and value == REQUEST_SYNC:
+            self.frame = bytearray([value])
+            self.frameTime = when
+            return
+
+        self.deviceFree = when + self.timing['asciiChar']
+        if value != ord('X'):
+            self.inputString.append(value)
+            return
+        command, self.inputString = bytes(self.inputString), bytearray()
+        self.mainFunction(self.deviceFree, command)
+
+    def mainFunction(self, when, command):
+        if not validCommand(command):
+            # nullString() and no answer
+            return
+        c = command[:1]
+        if c == b'W':
+            if len(command) == 69:
+                address, offset, count = char2byte(command[1:5]), 5, 32
+            elif len(command) == 71:
+                address, offset, count = char2byte(command[1:7]), 7, 32
+            else:
+                address, offset, count = char2byte(command[1:7]), 7, 8
+            data = bytearray(b'\xff') * 32
+            for i in range(count):
+                data[i] = char2byte(command[offset + 2 * i:offset + 2 * i + 2])
+            done = self.writeBuffer(when, address, data, count)
+            self.reply(done, b'K')
+        elif c == b'E':
+            done = self.busy(when, 'E', self.timing['erase'])
+            self.memory.erase()
+            self.reply(done, b'K')
+        elif c == b'R':
+            address = char2byte(command[1:7])
+            self.reply(when, b'K')
+            done, data = self.readBuffer(when, address, 32)
+            self.reply(done, ('R%06X' % address).encode('ascii') + data.hex().upper().encode('ascii')
+                       + b'X\r\n')
+        elif c == b'H':
+            done = self.busy(when, 'H', self.timing['hello'])
+            if command[1:2] == b'B' and self.binary:
+                self.reply(done, b'HB' + bytes([self.version, self.rxBuffer]))
+            else:
+                self.reply(done, b'H')
+        elif c == b'C':
+            done = self.busy(when, 'C', self.timing['config'])
+            self.writeConfig(char2byte(command[1:2]), char2byte(command[2:4]))
+            self.reply(done, b'K')
+        elif c == b'D':
+            done = self.busy(when, 'D', self.timing['deviceID'])
+            deviceID = self.memory.deviceID
+            self.reply(done, bytes([deviceID & 0xE0, deviceID >> 8]) + b'K')
+
+    def binaryFunction(self, when):
+        frame = self.frame
+        if len(frame) < 7:
+            return
+        seq, length = frame[2], frame[3]
+        if length > 64:
+            self.frame = None
+            self.reject(when, seq)
+            return
+        if len(frame) < 7 + length + 2:
+            return
+        self.frame = None
+
+        payload = bytes(frame[7:7 + length])
+        if crc16(bytes(frame[1:7 + length])) != int.from_bytes(frame[7 + length:], 'big'):
+            self.reject(when, seq)
+            return
+        address = int.from_bytes(frame[4:7], 'big')
+        command = self.opcodes.get(frame[1])
+        if command == 'F':
+            # W or V with the data run-length encoded: the command, then count, value pairs
+            data = b''.join(payload[i + 1:i + 2] * payload[i] for i in range(1, length - 1, 2))
+            packed = self.opcodes.get(payload[0])
+            if length % 2 == 0 or not 0 < len(data) <= 64 or packed not in ('W', 'V'):
+                self.reject(when, seq)
+                return
+            command, payload, length = packed, data, len(data)
+        if command == 'W':
+            data = bytearray(b'\xff') * 64
+            data[:length] = payload
+            done = self.writeBuffer(when, address, data, length)
+            self.reply(done, binaryReply(ACK, seq))
+        elif command == 'V':
+            data = bytearray(b'\xff') * 64
+            data[:length] = payload
+            done = self.writeBuffer(when, address, data, length)
+            done, data = self.readBuffer(done, address, length, 'V')
+            done += self.timing['crcByte'] * length
+            self.deviceFree = done
+            self.reply(done, binaryReply(ACK, seq, crc16(data).to_bytes(2, 'big')))
+        elif command == 'R' and length >= 1 and payload[0] <= 64:
+            done, data = self.readBuffer(when, address, payload[0])
+            self.reply(done, binaryReply(ACK, seq, data))
+        elif command == 'S' and length == 3:
+            count = int.from_bytes(payload, 'big')
+            done, data = self.readBuffer(when, address, count, 'S')
+            done += self.timing['crcByte'] * count
+            self.deviceFree = done
+            self.reply(done, binaryReply(ACK, seq, crc16(data).to_bytes(2, 'big')))
+        elif command == 'C' and length >= 1:
+            done = self.busy(when, 'C', self.timing['config'])
+            self.writeConfig(address & 0xFF, payload[0])
+            self.reply(done, binaryReply(ACK, seq))
+        elif command == 'B' and length >= 2 and length % 2 == 0:
+            # index, value pairs written in one programming mode entry
+            done = self.busy(when, 'B', self.timing['config'] * (length // 2))
+            for i in range(0, length, 2):
+                self.writeConfig(payload[i], payload[i + 1])
+            self.reply(done, binaryReply(ACK, seq))
+        else:
+            self.reject(when, seq)
+
+    def reject(self, when, seq):
+        # binaryReject drops whatever already is in the receive buffer
+        self.drainUntil = when
+        self.waiting.clear()
+        self.reply(when, binaryReply(NAK, seq))
+
+    def writeConfig(self, index, value):
+        if self.weakRate and self.random.random() < self.weakRate:
+            self.stats['weak'] += 1
+            return
+        self.memory.writeConfig(index, value)
+
+    def writeBuffer(self, when, address, data, count):
+        usb = address >> 16
+        if usb == 0x00:
+            # shorter writes are padded with 0xFF to the next buffer size
+            count = 64 if count > 32 else 32
+            seconds = self.timing['flashWrite'] + self.timing['flashWord'] * count // 2
+            done = self.busy(when, 'W', seconds)
+            if self.weakRate and self.random.random() < self.weakRate:
+                self.stats['weak'] += 1
+            elif not address & (count - 1):
+                self.memory.programFlash(address, data[:count])
+        elif usb == 0xF0:
+            written = [i for i in range(count) if data[i] != 0xFF]
+            done = self.busy(when, 'W', self.timing['eepromWrite'] * len(written))
+            for i in written:
+                self.memory.writeEEPROM(((address >> 8) & 0xFF) << 8 | ((address + i) & 0xFF), data[i])
+        elif usb == 0x20:
+            done = self.busy(when, 'W', self.timing['idWrite'])
+            self.memory.programID(data)
+        else:
+            done = self.busy(when, 'W', 0.0)
+        return done
+
+    def readBuffer(self, when, address, count, command='R'):
+        data = bytearray()
+        if address >> 16 == 0xF0:
+            for i in range(count):
+                data.append(self.memory.readEEPROM((address + i) & 0xFFFF))
+            seconds = self.timing['eepromRead'] * count
+        else:
+            for i in range(count):
+                data.append(self.memory.readFlash(address + i))
+            seconds = self.timing['tablePointer'] + self.timing['flashRead'] * count
+        return self.busy(when, command, seconds), data
+
+
+class PtyBridge:
+    # serves an Emulator on a pseudo terminal, name is the device to open
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.emulator.timeout = 0
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.name = os.ttyname(slave)
+        self.slave = slave
+        self.running = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def run(self):
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.001)
+            if readable:
+                try:
+                    self.emulator.write(os.read(self.master, 4096))
+                except OSError:
+                    break
+            data = self.emulator.read(4096)
+            if data:
+                os.write(self.master, data)
+
+
+def main():
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], 'm:b:l:d:c:a',
+                                           ['mcu=', 'baud=', 'latency=', 'byte-delay=',
+                                            'drop=', 'corrupt=', 'ascii', 'boot=', 'weak='])
+    except getopt.GetoptError as msg:
+        print(msg)
+        sys.exit(2)
+
+    device = DEFAULT_DEVICE
+    settings = {}
+    for opt, arg in options:
+        if opt in ('-m', '--mcu'):
+            device = byName(arg)
+            if device is None:
+                print("Unknown MCU " + arg)
+                sys.exit(2)
+        elif opt in ('-b', '--baud'):
+            settings['baudrate'] = int(arg)
+        elif opt in ('-l', '--latency'):
+            settings['latency'] = float(arg)
+        elif opt == '--byte-delay':
+            settings['byteDelay'] = float(arg)
+        elif opt in ('-d', '--drop'):
+            settings['dropRate'] = float(arg)
+        elif opt in ('-c', '--corrupt'):
+            settings['corruptRate'] = float(arg)
+        elif opt in ('-a', '--ascii'):
+            settings['binary'] = False
+        elif opt == '--boot':
+            settings['bootTime'] = float(arg)
+        elif opt == '--weak':
+            settings['weakRate'] = float(arg)
+
+    memory = PicMemory(device.deviceID, device.flashSize, device.eepromSize, device.configMasks)
+    bridge = PtyBridge(Emulator(memory, **settings)).start()
+    print("Emulated Arduino listening on " + bridge.name + ", Ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        bridge.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -17,59 +17,149 @@ Copyright (C) 2012-2020 Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefa
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import os
+import hashlib
 import sys
-import string
+from collections import namedtuple
 
-class Hex:
-    def __init__(self, fileName):
-        self.memory = [0] * 0x8000
-        self.havememory = [0] * int(0x8000/0x20)
-        self.eeprom = [0] * 0x100
-        self.haveeeprom = [0] * int(0x100/0x20)
+from Devices import MAX_FLASH_SIZE, MAX_EEPROM_SIZE
+
+# memory allocated when the part is not known yet, see Devices.py
+FLASH_SIZE = MAX_FLASH_SIZE
+EEPROM_SIZE = MAX_EEPROM_SIZE
+ID_SIZE = 0x8
+FUSE_SIZE = 0xF
+BLOCK_SIZE = 0x20
+
+# a block as it reads back after a bulk erase
+BLANK = b'\xff' * BLOCK_SIZE
+
+ID_BASE = 0x200000
+FUSE_BASE = 0x300000
+EEPROM_BASE = 0xF00000
+
+# Intel HEX record types, COMMENT is used for ';' lines
+DATA = 0
+EOF = 1
+EXTENDED_SEGMENT = 2
+START_SEGMENT = 3
+EXTENDED_LINEAR = 4
+START_LINEAR = 5
+COMMENT = -1
+
+Record = namedtuple('Record', 'line type address data')
+
+
+class HexError(Exception):
+    def __init__(self, line, message):
+        Exception.__init__(self, "line " + str(line) + ": " + message)
+        self.line = line
 
-        self.id = [0] * 0x8
 
+def readRecords(hexFile):
+    # yield one Record per line of a text or binary file object, e.g. sys.stdin or a pipe
+    for lineNumber, line in enumerate(hexFile, 1):
+        if isinstance(line, bytes):
+            line = line.decode('ascii', 'replace')
+        line = line.strip()
+        if line == "":
+            continue
+
+        # comment
+        if line.startswith(";"):
+            yield Record(lineNumber, COMMENT, 0, line)
+            continue
+
+        if not line.startswith(":"):
+            raise HexError(lineNumber, "record does not start with ':'")
+        try:
+            raw = bytes.fromhex(line[1:])
+        except ValueError:
+            raise HexError(lineNumber, "invalid hex digits")
+        if len(raw) < 5 or len(raw) != raw[0] + 5:
+            raise HexError(lineNumber, "record length does not match byte count")
+        if sum(raw) & 0xFF:
+            raise HexError(lineNumber, "checksum mismatch, expected "
+                           + hex(-sum(raw[:-1]) & 0xFF) + " got " + hex(raw[-1]))
+
+        recordType = raw[3]
+        if recordType > START_LINEAR:
+            raise HexError(lineNumber, "unknown record type " + str(recordType))
+        if recordType in (EXTENDED_SEGMENT, EXTENDED_LINEAR) and raw[0] != 2:
+            raise HexError(lineNumber, "address record must hold 2 bytes")
+
+        yield Record(lineNumber, recordType, (raw[1] << 8) | raw[2], raw[4:-1])
+
+
+def blockMask(start, length):
+    # bitmap of the BLOCK_SIZE blocks touched by [start, start + length)
+    first = start // BLOCK_SIZE
+    last = (start + length - 1) // BLOCK_SIZE
+    return ((1 << (last - first + 1)) - 1) << first
+
+
+class Hex:
+    def __init__(self, fileName, device=None):
+        # memory images sized for the part if it is known, unprogrammed flash reads back as 0xFF
+        self.device = device
+        self.flashSize = device.flashSize if device else FLASH_SIZE
+        self.eepromSize = device.eepromSize if device else EEPROM_SIZE
+        self.memory = bytearray(b'\xff') * self.flashSize
+        self.eeprom = bytearray(self.eepromSize)
+        self.id = bytearray(ID_SIZE)
+        self.fuseValue = bytearray(FUSE_SIZE)
+        self.fuseStatus = bytearray(FUSE_SIZE)
+
+        # zero-copy views used to write records and hand out blocks
+        self.memoryView = memoryview(self.memory)
+        self.eepromView = memoryview(self.eeprom)
+
+        # block-presence bitmaps, bit n set if block n holds data
+        self.havememory = 0
+        self.haveeeprom = 0
+        self.haveid = 0
 
         self.offset = 0
-        self.fuseValue = [0] * 0xF
-        self.fuseStatus = [0] * 0xF
-
-        fileSize = int(os.path.getsize(fileName))
-        hexFile = open(fileName, 'r')
-
-        for i in range(0x8000):
-            self.memory[i] = 0xFF
-            self.havememory[int(i/0x20)] = 0
-        for i in range(0x100):
-            self.eeprom[i] = 0
-            self.haveeeprom[int(i/0x20)] = 0
-        for i in range(0x8):
-            self.id[i] = 0
-            self.haveid = 0
-        for i in range(0x0F):
-            self.fuseStatus[i] = 0
-
-        while True:
-            buf = hexFile.readline(128).replace(':','').replace('\n','')
-            if buf == "":
-                break
-            if self.reformat(buf) == 1:
-                print("Hex file not valid.")
-                sys.exit(2)
-        hexFile.close()
+        self.comments = []
+
+        # runs of non-blank blocks by memory, see segments
+        self.segmentIndex = {}
+
+        # filled in by a programming plan, see Plan.py: ASCII frames by
+        # address and region CRCs by (address, length)
+        self.frames = {}
+        self.crcs = {}
+
+        # fileName may be a path, '-' for stdin or an open file object
+        if hasattr(fileName, 'read'):
+            self.load(fileName)
+        elif fileName == '-':
+            self.load(sys.stdin)
+        else:
+            with open(fileName, 'r') as hexFile:
+                self.load(hexFile)
+
+    def load(self, hexFile):
+        for record in readRecords(hexFile):
+            self.addRecord(record)
 
     def getData(self, address):
         return self.memory[address]
 
-    def haveData(self, address):
-        return self.havememory[int(address/0x20)]
+    def getBlock(self, address, size=BLOCK_SIZE):
+        return self.memoryView[address:address + size]
+
+    def haveData(self, address, size=BLOCK_SIZE):
+        # true if any BLOCK_SIZE block of [address, address + size) holds data
+        return (self.havememory >> (address // BLOCK_SIZE)) & ((1 << (size // BLOCK_SIZE)) - 1)
 
     def getEEPROM(self, address):
         return self.eeprom[address]
 
+    def getEEPROMBlock(self, address, size=BLOCK_SIZE):
+        return self.eepromView[address:address + size]
+
     def haveEEPROM(self, address):
-        return self.haveeeprom[int(address/0x20)]
+        return (self.haveeeprom >> (address // BLOCK_SIZE)) & 1
 
     def getID(self, address):
         return self.id[address]
@@ -83,111 +173,95 @@ class Hex:
     def getFuse(self, fuseID):
         return self.fuseValue[fuseID]
 
-    # HEX parser
-    def reformat(self, hexData):
-        buf = hexData
-
-        # comment
-        if hexData.startswith(";"):
-            print(hexData)
-            return 0
-
-        iSize, buf = int(buf[:2], 16), buf[2:]
-        if iSize == -1:
-            return 1
-        iAddress, buf = int(buf[:4], 16), buf[4:]
-        if iAddress == -1:
-            return 1
-        # record type
-        iRecord = int(buf[:2], 16)
-
-        if iRecord == -1:
-            return 1
-        elif iRecord == 4:
-
-            buf = buf[2:]
-            temp = int(buf[:2], 16)
-            if temp == -1:
-                return 1
-            self.offset += temp << 24
-            buf = buf[2:]
-            temp = int(buf[:2], 16)
-            if temp == -1:
-                return 1
-            self.offset = temp << 16
-
-        elif iRecord == 2:
-
-            buf = buf[2:]
-            temp = int(buf[:2], 16)
-            if temp == -1:
-                return 1
-            self.offset += temp << 12
-            buf = buf[2:]
-            temp = int(buf[:2], 16)
-            if temp == -1:
-                return 1
-            self.offset = temp << 4
-
-        elif iRecord == 0:
+    def segments(self, eeprom=False):
+        # maximal runs [start, end) of blocks that hold data other than 0xFF,
+        # the erased state; built on first use
+        index = self.segmentIndex.get(eeprom)
+        if index is not None:
+            return index
+        if eeprom:
+            bitmap, region = self.haveeeprom, self.eeprom
+        else:
+            bitmap, region = self.havememory, self.memory
+        bits = bin(bitmap)[:1:-1]
+        index = []
+        block = bits.find('1')
+        while block >= 0:
+            address = block * BLOCK_SIZE
+            if region[address:address + BLOCK_SIZE] != BLANK:
+                if index and index[-1][1] == address:
+                    index[-1] = (index[-1][0], address + BLOCK_SIZE)
+                else:
+                    index.append((address, address + BLOCK_SIZE))
+            block = bits.find('1', block + 1)
+        self.segmentIndex[eeprom] = index
+        return index
+
+    def fits(self, device):
+        # None if the image fits the part, else what is out of range
+        if self.havememory >> (device.flashSize // BLOCK_SIZE):
+            return "flash data beyond " + hex(device.flashSize)
+        if self.haveeeprom >> (device.eepromSize // BLOCK_SIZE):
+            return "EEPROM data beyond " + hex(device.eepromSize)
+        return None
+
+    def digest(self):
+        # identifies the parsed image, independent of the record layout of the
+        # file and of the memory allocated for it
+        sha = hashlib.sha256()
+        for bitmap, region in ((self.havememory, self.memory), (self.haveeeprom, self.eeprom)):
+            used = bitmap.bit_length() * BLOCK_SIZE
+            sha.update(used.to_bytes(4, 'little'))
+            sha.update(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little'))
+            sha.update(region[:used])
+        for region in (self.id, self.fuseValue, self.fuseStatus):
+            sha.update(region)
+        sha.update(bytes([self.haveid]))
+        return sha.hexdigest()
+
+    def addRecord(self, record):
+        if record.type == COMMENT:
+            print(record.data)
+            self.comments.append(record.data)
+
+        elif record.type == EXTENDED_LINEAR:
+            self.offset = ((record.data[0] << 8) | record.data[1]) << 16
+
+        elif record.type == EXTENDED_SEGMENT:
+            self.offset = ((record.data[0] << 8) | record.data[1]) << 4
+
+        elif record.type == EOF:
+            # a concatenated image starts over from offset 0
+            self.offset = 0
+
+        elif record.type == DATA and record.data:
+            self.segmentIndex.clear()
+            data = record.data
+            size = len(data)
+            address = record.address + self.offset
+            end = address + size
 
             # Memory
-            if (iAddress + self.offset) < 0x8000:
-                for i in range(int(iSize / 2)):
-                    buf = buf[2:]
-
-                    self.memory[iAddress + i * 2 + self.offset] = int(buf[:2], 16)
-                    if self.memory[iAddress + i * 2 + self.offset] == -1:
-                        return 1
-
-                    self.havememory[int((iAddress + i * 2 + self.offset)/0x20)] = 1
-
-                    buf = buf[2:]
-                    self.memory[iAddress + i * 2 + self.offset + 1] = int(buf[:2], 16)
-                    if self.memory[iAddress + i * 2 + self.offset + 1] == -1:
-                        return 1
-
-                    self.havememory[int((iAddress + i * 2 + self.offset + 1)/0x20)] = 1
+            if end <= self.flashSize:
+                self.memoryView[address:end] = data
+                self.havememory |= blockMask(address, size)
 
             # Id
-            elif iAddress + self.offset >= 0x200000 and iAddress + self.offset <= 0x200007:
-                for i in range(iSize):
-                    buf = buf[2:]
-                    self.id[iAddress + self.offset + i - 0x200000] = int(buf[:2], 16)
-                    if int(buf[:2], 16) == -1:
-                        return 1
-
-                    self.haveid = 1
+            elif address >= ID_BASE and end <= ID_BASE + ID_SIZE:
+                self.id[address - ID_BASE:end - ID_BASE] = data
+                self.haveid = 1
 
             # Fuse values
-            elif iAddress + self.offset >= 0x300000 and iAddress + self.offset <= 0x30000F:
-                for i in range(iSize):
-                    buf = buf[2:]
-                    self.fuseValue[iAddress + self.offset + i - 0x300000] = int(buf[:2], 16)
-                    if int(buf[:2], 16) == -1:
-                        return 1
-
-                    self.fuseStatus[iAddress + self.offset + i - 0x300000] = 1
+            elif address >= FUSE_BASE and end <= FUSE_BASE + FUSE_SIZE:
+                self.fuseValue[address - FUSE_BASE:end - FUSE_BASE] = data
+                self.fuseStatus[address - FUSE_BASE:end - FUSE_BASE] = b'\x01' * size
 
             # EEPROM
-            elif (iAddress + self.offset) >= 0xF00000 and iAddress + self.offset <= 0xF000FF:
-                for i in range(int(iSize / 2)):
-                    buf = buf[2:]
-                    self.eeprom[iAddress + i * 2 + self.offset - 0xF00000] = int(buf[:2], 16)
-                    if self.eeprom[iAddress + i * 2 + self.offset - 0xF00000] == -1:
-                        return 1
-
-                    self.haveeeprom[(iAddress + i * 2 + self.offset - 0xF00000)/0x20] = 1
-
-                    buf = buf[2:]
-                    self.eeprom[iAddress + i * 2 + self.offset - 0xF00000 + 1] = int(buf[:2], 16)
-                    if self.eeprom[iAddress + i * 2 + self.offset - 0xF00000 + 1] == -1:
-                        return 1
-
-                    self.haveeeprom[(iAddress + i * 2 + self.offset - 0xF00000 + 1)/0x20] = 1
+            elif address >= EEPROM_BASE and end <= EEPROM_BASE + self.eepromSize:
+                self.eepromView[address - EEPROM_BASE:end - EEPROM_BASE] = data
+                self.haveeeprom |= blockMask(address - EEPROM_BASE, size)
 
             # Unknown data
             else:
-                print(hex(iAddress + self.offset))
-                return 1
-        return 0
+                raise HexError(record.line, "data outside of the device memory at "
+                               + hex(address))
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Remembers the digest of the last image successfully flashed per serial port
+# and device, stored as JSON in $XDG_CACHE_HOME/pic_programmer/flashed.json
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+def cacheDirectory():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pic_programmer')
+
+
+class ImageCache:
+    # stations programming in parallel share the file
+    lock = threading.Lock()
+
+    def __init__(self, fileName=None):
+        self.fileName = fileName or os.path.join(cacheDirectory(), 'flashed.json')
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.fileName, 'r') as cacheFile:
+                return json.load(cacheFile)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def key(port, device):
+        return os.path.realpath(port) + "|" + str(device)
+
+    def get(self, port, device):
+        entry = self.entries.get(self.key(port, device))
+        return entry['digest'] if entry else None
+
+    def put(self, port, device, digest):
+        with self.lock:
+            self.entries = self.load()
+            self.entries[self.key(port, device)] = {'digest': digest, 'time': time.time()}
+            self.save()
+
+    def forget(self, port, device):
+        with self.lock:
+            self.entries = self.load()
+            if self.entries.pop(self.key(port, device), None) is not None:
+                self.save()
+
+    def save(self):
+        # write a new file and rename it so a crash never leaves half a cache
+        directory = os.path.dirname(self.fileName)
+        os.makedirs(directory, exist_ok=True)
+        fd, tempName = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as cacheFile:
+            json.dump(self.entries, cacheFile, indent=1, sort_keys=True)
+        os.replace(tempName, self.fileName)
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Where the time of a programming run goes: wall time and bytes sent and
+# received per phase, plus a histogram of the round trip time of every
+# command, and how much smaller run-length encoding made the write frames.
+# A callback is told about every phase that starts as
+# callback("start", record), gets it again as callback("phase", record) once
+# it finished and the whole report as callback("report", report).
+
+import json
+import time
+from contextlib import contextmanager
+
+# upper bounds of the round trip histogram buckets in milliseconds
+BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class Metrics:
+    def __init__(self, callback=None, now=time.monotonic):
+        self.callback = callback
+        self.now = now
+        self.started = now()
+        self.sent = 0
+        self.received = 0
+        self.phases = []
+        self.roundTrips = {}
+        self.blocks = 0
+        self.blockBytes = 0
+        self.payloadBytes = 0
+
+    @contextmanager
+    def phase(self, name):
+        start, sent, received = self.now(), self.sent, self.received
+        record = {'phase': name, 'ok': False}
+        if self.callback is not None:
+            self.callback("start", record)
+        try:
+            yield record
+            record['ok'] = True
+        finally:
+            record['seconds'] = self.now() - start
+            record['sent'] = self.sent - sent
+            record['received'] = self.received - received
+            if record['seconds'] > 0:
+                record['bytesPerSecond'] = (record['sent'] + record['received']) / record['seconds']
+            self.phases.append(record)
+            if self.callback is not None:
+                self.callback("phase", record)
+
+    def roundTrip(self, command, seconds):
+        stats = self.roundTrips.get(command)
+        if stats is None:
+            stats = self.roundTrips[command] = {'count': 0, 'total': 0.0, 'min': seconds,
+                                                'max': seconds, 'buckets': [0] * (len(BUCKETS) + 1)}
+        stats['count'] += 1
+        stats['total'] += seconds
+        stats['min'] = min(stats['min'], seconds)
+        stats['max'] = max(stats['max'], seconds)
+        milliseconds = seconds * 1000
+        index = next((i for i, bound in enumerate(BUCKETS) if milliseconds <= bound), len(BUCKETS))
+        stats['buckets'][index] += 1
+
+    def payload(self, data, payload):
+        # a block of data bytes was sent as a payload of payload bytes
+        self.blocks += 1
+        self.blockBytes += data
+        self.payloadBytes += payload
+
+    def ratio(self):
+        # block bytes per payload byte sent, 1 if nothing was compressed
+        return self.blockBytes / self.payloadBytes if self.payloadBytes else 1.0
+
+    def report(self):
+        roundTrips = {}
+        for command, stats in sorted(self.roundTrips.items()):
+            histogram = {}
+            for i, count in enumerate(stats['buckets']):
+                if count:
+                    label = "<=%gms" % BUCKETS[i] if i < len(BUCKETS) else ">%gms" % BUCKETS[-1]
+                    histogram[label] = count
+            roundTrips[command] = {'count': stats['count'], 'mean': stats['total'] / stats['count'],
+                                   'min': stats['min'], 'max': stats['max'],
+                                   'histogram': histogram}
+        return {'seconds': self.now() - self.started, 'sent': self.sent,
+                'received': self.received, 'phases': self.phases, 'roundTrips': roundTrips,
+                'writes': {'blocks': self.blocks, 'data': self.blockBytes,
+                           'payload': self.payloadBytes, 'ratio': self.ratio()}}
+
+    def finish(self):
+        report = self.report()
+        if self.callback is not None:
+            self.callback("report", report)
+        return report
+
+
+def saveReport(report, fileName):
+    # '-' prints the report
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if fileName == '-':
+        print(text)
+        return
+    with open(fileName, 'w') as f:
+        f.write(text + "\n")
+
+
+class MeteredSerial:
+    # counts the bytes going through a pyserial object into metrics, which
+    # can be replaced between jobs; everything else is passed through unchanged
+    def __init__(self, serial, metrics):
+        self.serial = serial
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['serial'], name)
+
+    def __setattr__(self, name, value):
+        if name in ('serial', 'metrics'):
+            self.__dict__[name] = value
+        else:
+            setattr(self.serial, name, value)
+
+    def write(self, data):
+        self.metrics.sent += len(data)
+        return self.serial.write(data)
+
+    def read(self, size=1):
+        data = self.serial.read(size)
+        self.metrics.received += len(data)
+        return data
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# A programming plan is a parsed hex file together with everything a run
+# derives from it: the ASCII W frame of every block and the CRC of every
+# region the verification asks the arduino for. Plans are cached in
+# $XDG_CACHE_HOME/pic_programmer/plans/<sha256 of the hex file>.plan and
+# mapped into memory, so flashing the same file again skips parsing and
+# encoding. Binary frames carry a new sequence number on every transmission
+# and are still built while sending, from the mapped payload.
+#
+# File layout, numbers little endian:
+#   header    see HEADER below
+#   memory    flash, EEPROM and ID image
+#   regions   address u32, length u32, crc u16 for every verify region
+#   frames    address u32, offset u32, frame length u16, data length u16 for
+#             every block, then the frames
+#   comments  the ';' lines of the hex file, newline separated
+
+import hashlib
+import io
+import mmap
+import os
+import struct
+import tempfile
+
+from Devices import byName
+from Hex import Hex, ID_SIZE, FUSE_SIZE, BLOCK_SIZE
+from ImageCache import cacheDirectory
+from Protocol import asciiWrite, crc16
+
+MAGIC = b'PICPLAN'
+PLAN_VERSION = 2
+
+# magic, version, sha256 of the hex file, image digest, part the memory was
+# allocated for, flash size, EEPROM size, ID size, block size, haveid, fuse values,
+# fuse status, region count, frame count, frame data size, comment size
+HEADER = struct.Struct('<7sB32s64s16sIIIHB%ds%dsIIII' % (FUSE_SIZE, FUSE_SIZE))
+REGION = struct.Struct('<IIH')
+FRAME = struct.Struct('<IIHH')
+
+# plans kept in the cache, the oldest are removed first
+PLAN_LIMIT = 64
+
+
+def planDirectory():
+    return os.path.join(cacheDirectory(), 'plans')
+
+
+def bitmapSize(size):
+    return (size // BLOCK_SIZE + 7) // 8
+
+
+class Plan(Hex):
+    # a Hex whose memory is a read-only view of the mapped plan file
+    def __init__(self, fileName):
+        with open(fileName, 'rb') as planFile:
+            self.map = mmap.mmap(planFile.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        try:
+            (magic, version, self.source, digest, device, self.flashSize, self.eepromSize,
+             idSize, blockSize, self.haveid, fuseValue, fuseStatus, regionCount, frameCount,
+             frameSize, commentSize) = HEADER.unpack_from(view)
+        except struct.error:
+            raise ValueError("truncated plan " + fileName)
+        if magic != MAGIC or version != PLAN_VERSION or (idSize, blockSize) != (ID_SIZE, BLOCK_SIZE):
+            raise ValueError("plan " + fileName + " was made for another version")
+        self.imageDigest = digest.decode('ascii')
+        self.device = byName(device.rstrip(b'\0').decode('ascii'))
+        self.fuseValue = fuseValue
+        self.fuseStatus = fuseStatus
+
+        offset = HEADER.size
+        self.havememory = int.from_bytes(view[offset:offset + bitmapSize(self.flashSize)], 'little')
+        offset += bitmapSize(self.flashSize)
+        self.haveeeprom = int.from_bytes(view[offset:offset + bitmapSize(self.eepromSize)], 'little')
+        offset += bitmapSize(self.eepromSize)
+
+        self.memory = self.memoryView = view[offset:offset + self.flashSize]
+        offset += self.flashSize
+        self.eeprom = self.eepromView = view[offset:offset + self.eepromSize]
+        offset += self.eepromSize
+        self.id = view[offset:offset + ID_SIZE]
+        offset += ID_SIZE
+
+        self.crcs = {}
+        for i in range(regionCount):
+            address, length, crc = REGION.unpack_from(view, offset)
+            self.crcs[(address, length)] = crc
+            offset += REGION.size
+
+        table = offset
+        data = table + frameCount * FRAME.size
+        self.frames = {}
+        for i in range(frameCount):
+            address, start, length, dataLength = FRAME.unpack_from(view, table + i * FRAME.size)
+            self.frames[(address, dataLength)] = view[data + start:data + start + length]
+        offset = data + frameSize
+
+        if len(view) != offset + commentSize:
+            raise ValueError("truncated plan " + fileName)
+        self.comments = bytes(view[offset:]).decode('utf-8').split("\n") if commentSize else []
+        self.offset = 0
+        self.segmentIndex = {}
+
+    def digest(self):
+        return self.imageDigest
+
+
+def compilePlan(hexFile, source, layout, fileName):
+    # write the plan of a parsed image, source is the sha256 of the hex file;
+    # layout(hexFile) returns the (address, data) blocks sent as ASCII frames
+    # and the regions the verification will ask a CRC for
+    blocks, regions = layout(hexFile)
+    table = bytearray()
+    frames = bytearray()
+    blockCount = 0
+    for address, data in blocks:
+        frame = asciiWrite(address, data)
+        table += FRAME.pack(address, len(frames), len(frame), len(data))
+        frames += frame
+        blockCount += 1
+
+    regionTable = bytearray()
+    regionCount = 0
+    for address, data in regions:
+        regionTable += REGION.pack(address, len(data), crc16(data))
+        regionCount += 1
+
+    comments = "\n".join(hexFile.comments).encode('utf-8')
+    device = hexFile.device.name.encode('ascii') if hexFile.device else b''
+    header = HEADER.pack(MAGIC, PLAN_VERSION, source, hexFile.digest().encode('ascii'), device,
+                         hexFile.flashSize, hexFile.eepromSize, ID_SIZE, BLOCK_SIZE,
+                         hexFile.haveID(), bytes(hexFile.fuseValue), bytes(hexFile.fuseStatus),
+                         regionCount, blockCount, len(frames), len(comments))
+
+    # write a new file and rename it so a crash never leaves half a plan
+    directory = os.path.dirname(fileName)
+    os.makedirs(directory, exist_ok=True)
+    fd, tempName = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as planFile:
+        for part in (header, hexFile.havememory.to_bytes(bitmapSize(hexFile.flashSize), 'little'),
+                     hexFile.haveeeprom.to_bytes(bitmapSize(hexFile.eepromSize), 'little'),
+                     hexFile.memory, hexFile.eeprom, hexFile.id, regionTable, table, frames,
+                     comments):
+            planFile.write(part)
+    os.replace(tempName, fileName)
+
+
+def prunePlans(directory, limit=PLAN_LIMIT):
+    plans = [os.path.join(directory, name) for name in os.listdir(directory)
+             if name.endswith('.plan')]
+    if len(plans) <= limit:
+        return
+    plans.sort(key=os.path.getmtime)
+    for fileName in plans[:-limit]:
+        try:
+            os.remove(fileName)
+        except OSError:
+            pass
+
+
+def loadPlan(text, layout, device=None, directory=None):
+    # the plan of the hex file text (bytes), compiled and cached on first use,
+    # see compilePlan for layout. The memory is allocated for device, or the
+    # largest part if it is None; a cached plan may have been made for another
+    # part, Hex.fits tells if it fits. Falls back to a plain parse if the
+    # cache can not be written.
+    source = hashlib.sha256(text).digest()
+    directory = directory or planDirectory()
+    fileName = os.path.join(directory, source.hex() + '.plan')
+    try:
+        plan = Plan(fileName)
+        for comment in plan.comments:
+            print(comment)
+        os.utime(fileName)
+        return plan
+    except (OSError, ValueError):
+        pass
+
+    hexFile = Hex(io.BytesIO(text), device)
+    try:
+        compilePlan(hexFile, source, layout, fileName)
+        prunePlans(directory)
+        return Plan(fileName)
+    except (OSError, ValueError):
+        return hexFile
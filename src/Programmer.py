@@ -0,0 +1,283 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Programming from another python program, e.g. a test executive flashing
+# thousands of boards from one process. The port stays open and images stay
+# parsed between calls, failures raise a ProgrammerError instead of
+# returning an exit code.
+#
+#   from Programmer import Programmer, Image
+#   image = Image(open('blink.hex'))
+#   with Programmer('/dev/ttyACM0', progress=lambda event, record: ...) as chip:
+#       chip.program(image)
+#
+# progress gets the metrics events: ("start", record) when a phase like
+# "flash write" begins, ("phase", record) with its time and bytes when it
+# ended. output gets every line the programmer prints, None leaves them on
+# stdout.
+
+import io
+import sys
+from contextlib import contextmanager, redirect_stdout
+from serial import *
+from Dump import HexWriter
+from Hex import Hex, HexError, FUSE_BASE, FUSE_SIZE
+from Metrics import Metrics
+from Protocol import ProtocolError, REPLY_TIMEOUT
+import pic_programmer
+
+
+class ProgrammerError(Exception):
+    pass
+
+
+class ImageError(ProgrammerError):
+    # the image is not a valid hex file
+    pass
+
+
+class ConnectError(ProgrammerError):
+    # the port could not be opened or the firmware did not answer
+    pass
+
+
+class LinkError(ProgrammerError):
+    # the connection was lost or the arduino answered nonsense; the port is
+    # closed and opened again by the next call
+    pass
+
+
+class DeviceError(ProgrammerError):
+    # the part is not supported or the image does not fit it
+    pass
+
+
+class EraseError(ProgrammerError):
+    pass
+
+
+class VerifyError(ProgrammerError):
+    # regions holds the Mismatches of flash, ID, EEPROM and configuration;
+    # flash, ID and EEPROM are missing if the blocks were verified while
+    # writing them
+    def __init__(self, message, regions=()):
+        ProgrammerError.__init__(self, message)
+        self.regions = list(regions)
+
+
+class Image:
+    # a parsed image, flashed any number of times. source is the text of a
+    # hex file as str or bytes, an open file, or a dict mapping addresses to
+    # bytes: flash from 0, ID at 0x200000, configuration at 0x300000 and
+    # EEPROM at 0xF00000. The image has to fit device, the largest part if
+    # it is None.
+    def __init__(self, source, device=None):
+        if isinstance(source, dict):
+            text = io.StringIO()
+            writer = HexWriter(text)
+            for address in sorted(source):
+                writer.write(address, bytes(source[address]))
+            writer.close()
+            source = text.getvalue()
+        elif hasattr(source, 'read'):
+            source = source.read()
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        # parsed in memory, images built per unit would each leave a plan
+        # in the cache directory
+        try:
+            self.hexFile = Hex(io.BytesIO(bytes(source)), device)
+        except HexError as msg:
+            raise ImageError(str(msg))
+
+    def fits(self, device):
+        return self.hexFile.fits(device)
+
+    def digest(self):
+        return self.hexFile.digest()
+
+
+class Programmer:
+    # one Arduino, connected on the first call and kept open until close();
+    # metrics covers the last call
+    def __init__(self, port, mcu="", asciiMode=False, noReset=False, timeout=REPLY_TIMEOUT,
+                 window=pic_programmer.DEFAULT_WINDOW, interleave=False, verbose=False,
+                 progress=None, output=None):
+        self.port = port
+        self.mcu = mcu
+        self.asciiMode = asciiMode
+        self.noReset = noReset
+        self.timeout = timeout
+        self.window = window
+        self.interleave = interleave
+        self.verbose = verbose
+        self.progress = progress
+        self.output = output
+        self.arduino = None
+        self.link = None
+        self.device = None
+        self.metrics = Metrics(progress)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    @contextmanager
+    def captured(self):
+        # the lines printed by this thread go to output
+        if self.output is None:
+            yield
+            return
+        sink = pic_programmer.ThreadOutput(sys.stdout)
+        sink.start(self.output)
+        try:
+            with redirect_stdout(sink):
+                yield
+        finally:
+            sink.finish()
+
+    def connect(self):
+        with self.captured():
+            print("Connecting to arduino...", end = '')
+            try:
+                with self.metrics.phase("open port"):
+                    self.arduino = pic_programmer.openArduino(self.port, self.noReset, self.metrics)
+            except (SerialException, OSError) as msg:
+                print(msg)
+                raise ConnectError(str(msg))
+            try:
+                with self.metrics.phase("connect"):
+                    self.link = pic_programmer.connect(self.arduino, self.asciiMode, self.verbose,
+                                                       self.metrics, self.timeout)
+            except (ProtocolError, SerialException, OSError) as msg:
+                # the port opened but the handshake failed, do not leave it half open
+                print(msg)
+                self.close()
+                raise ConnectError(str(msg))
+        if self.link is None:
+            self.close()
+            raise ConnectError("no answer from the arduino on " + self.port)
+
+    def close(self):
+        if self.arduino is not None:
+            try:
+                self.arduino.close()
+            except (SerialException, OSError):
+                pass
+        self.arduino = None
+        self.link = None
+        self.device = None
+
+    def run(self, job):
+        # job(link) on a fresh metrics, connecting first if needed; a
+        # connection that got lost or may be stuck in the middle of a frame is
+        # closed. Failures to connect raise ConnectError, later ones LinkError.
+        self.metrics = Metrics(self.progress)
+        try:
+            if self.link is None:
+                self.connect()
+            else:
+                self.arduino.metrics = self.metrics
+                self.link.metrics = self.metrics
+            with self.captured():
+                return job(self.link)
+        except (ProtocolError, SerialException, OSError) as msg:
+            self.close()
+            raise LinkError(str(msg))
+
+    def part(self, link, image=None):
+        # the part connected, detected on every job: boards may be swapped
+        # while the port stays open
+        self.device = pic_programmer.findDevice(link, self.mcu)
+        if self.device is None:
+            raise DeviceError("part not supported or not connected")
+        if image is not None:
+            error = image.fits(self.device)
+            if error is not None:
+                raise DeviceError("image does not fit the " + self.device.name + ": " + error)
+        return self.device
+
+    def eraseChip(self, link):
+        with link.metrics.phase("erase"):
+            if not pic_programmer.eraseChip(link):
+                raise EraseError("the chip could not be erased")
+
+    def readDevice(self):
+        # the Device connected, see Devices.py
+        return self.run(self.part)
+
+    def deviceID(self):
+        # DEVID2:DEVID1 with the revision bits cleared, as the firmware sends it
+        return self.run(lambda link: link.deviceID())
+
+    def erase(self):
+        def job(link):
+            self.part(link)
+            self.eraseChip(link)
+        self.run(job)
+
+    def program(self, image):
+        # erase, write, verify and write the fuses of image
+        if not isinstance(image, Image):
+            image = Image(image)
+
+        def job(link):
+            device = self.part(link, image)
+            self.eraseChip(link)
+            regions = []
+            if not pic_programmer.program(link, image.hexFile, self.verbose, False,
+                                          self.window, device, self.interleave, regions):
+                raise VerifyError(summary(regions), regions)
+        self.run(job)
+
+    def verify(self, image):
+        if not isinstance(image, Image):
+            image = Image(image)
+
+        def job(link):
+            device = self.part(link, image)
+            regions = []
+            if not pic_programmer.verifyImage(link, image.hexFile, self.verbose, regions, device):
+                raise VerifyError(summary(regions), regions)
+        self.run(job)
+
+    def writeFuses(self, image):
+        if not isinstance(image, Image):
+            image = Image(image)
+
+        def job(link):
+            device = self.part(link, image)
+            pic_programmer.writeFuses(link, image.hexFile, self.verbose)
+            regions = []
+            if not pic_programmer.verifyFuses(link, image.hexFile, device, self.verbose, regions):
+                raise VerifyError(summary(regions), regions)
+        self.run(job)
+
+    def readFuses(self):
+        # CONFIG1L to CONFIG7H
+        return self.run(lambda link: link.read(FUSE_BASE, FUSE_SIZE))
+
+
+def summary(regions):
+    if not any(region.count for region in regions):
+        return "blocks did not read back as written"
+    return "%d bytes differ in %d ranges" % (sum(region.count for region in regions),
+                                             sum(len(region.ranges) for region in regions))
@@ -0,0 +1,629 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Wire protocol between the PC and PIC18f_auto.ino
+#
+# ASCII mode (every firmware version), frames end with 'X':
+#   W<address 4 or 6 hex digits><data in hex>X  -> K
+#   R<address 6 hex digits>X                    -> KR<address><32 bytes in hex>X
+#   C<config index 1 hex digit><value>X         -> K
+#
+# The firmware starts only after the bootloader gave up, which takes about
+# 1.5 s after the port was opened; HX is repeated until it answers.
+#
+# Binary mode, negotiated by sending HBX. Firmware that knows it answers
+# H B <version> <receive buffer size>, older firmware only answers H.
+#   request: A5 <command> <seq> <length> <address 3 bytes, MSB first> <payload> <crc16>
+#   reply:   5A <status> <seq> <length> <payload> <crc16>
+# The CRC is CRC-16/CCITT (polynomial 0x1021, start 0xFFFF) over everything
+# between the sync byte and the CRC, sent MSB first. Status is K or N.
+# R carries the number of bytes to read as its payload, C carries the value
+# and the config index as address.
+# S (version 2) carries a 3 byte length and answers the CRC of that many bytes
+# starting at address, computed on the arduino.
+# Version 3 takes W frames of 64 bytes for parts with a 64 byte write buffer,
+# ASCII frames always hold 32 bytes.
+# V (version 4) is a W answered with the CRC of the written bytes as they
+# read back, so a block is verified without a round trip of its own.
+# F (version 5) is a W or V with the data run-length encoded, the payload is
+# the command followed by count, value pairs; it is answered like the
+# command it carries and sent whenever it is shorter than the plain frame.
+# B (version 6) writes several configuration bytes, the payload holds
+# index, value pairs.
+# From version 7 the command byte is the letter with the top bit set, see
+# opcode(), so no binary command reads as one of the ASCII commands.
+#
+# A frame that loses its sync byte is taken for the start of an ASCII
+# command. The firmware only runs ASCII commands of the exact length with
+# nothing but hex digits after the letter, so the rest of a frame is
+# dropped without touching the part. After a lost, damaged or rejected
+# frame the host sends RESYNC, which ends that command with a character it
+# is rejected for, waits until the arduino stayed quiet for RESYNC_TIME and
+# sends the frames again with new sequence numbers.
+
+import binascii
+import re
+import time
+from collections import deque
+from Metrics import Metrics
+
+REQUEST_SYNC = 0xA5
+REPLY_SYNC = 0x5A
+ACK = ord('K')
+NAK = ord('N')
+
+PROTOCOL_VERSION = 7
+OPCODE_VERSION = 7
+MAX_PAYLOAD = 0x40
+MAX_RETRIES = 5
+
+# writes of a block that reads back wrong, after the first one
+MAX_REWRITES = 2
+
+# seconds to wait for the firmware to start, and for the answer to one hello
+CONNECT_TIMEOUT = 5.0
+HELLO_TIMEOUT = 0.05
+
+# sent to resync: Z is no hex digit, so whatever command the firmware is
+# collecting is dropped when the X ends it instead of being run; a frame the
+# firmware is still reading fails its CRC and is answered with N
+RESYNC = b'ZX'
+
+# seconds the arduino has to stay quiet after a resync; longer than the
+# 100 ms the firmware waits for the rest of a frame that lost a byte
+RESYNC_TIME = 0.15
+
+# seconds a reply may stall before it is given up, the slowest command is D;
+# a CRC is computed before the arduino answers, so S requests get CRC_BYTE_TIME
+# more per byte, enough for EEPROM reads
+REPLY_TIMEOUT = 1.0
+CRC_BYTE_TIME = 0.002
+
+# a run of one byte value, at most 255 long so its count fits a byte
+RUN = re.compile(b'(.)\\1{0,254}', re.DOTALL)
+
+# what an ASCII reply may be preceded by: acknowledgments and line ends
+# left over from earlier replies
+STRAY = b'K\r\n'
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ReplyTimeout(ProtocolError):
+    pass
+
+
+def crc16(data, crc=0xFFFF):
+    return binascii.crc_hqx(data, crc)
+
+
+def asciiWrite(address, data):
+    # flash keeps the short 4 digit address form understood by every firmware
+    if address < 0x10000 and len(data) == 0x20:
+        return ("W%04X" % address).encode('ascii') + binascii.hexlify(data).upper() + b'X'
+    return ("W%06X" % address).encode('ascii') + binascii.hexlify(data).upper() + b'X'
+
+
+def asciiRead(address):
+    return ("R%06XX" % address).encode('ascii')
+
+
+def asciiConfig(index, value):
+    return ("C%X%02XX" % (index, value)).encode('ascii')
+
+
+def writeChecked(link, address, data, write):
+    # write(), compare the block right away and write it again while it
+    # differs; False if it still does after MAX_REWRITES more writes
+    for attempt in range(MAX_REWRITES + 1):
+        if attempt:
+            link.rewrites += 1
+            if link.verbose:
+                print("rewriting " + hex(address))
+        write()
+        if link.matches(address, data):
+            return True
+    return False
+
+
+def runLength(data):
+    # count, value pairs of the runs in data
+    return b''.join(bytes([len(run.group()), run.group()[0]]) for run in RUN.finditer(data))
+
+
+def opcode(command, version=PROTOCOL_VERSION):
+    # the byte a binary command is sent as; older firmware takes the plain
+    # letter, which a frame without its sync byte runs as an ASCII W, R or C
+    if version >= OPCODE_VERSION:
+        return ord(command) | 0x80
+    return ord(command)
+
+
+def binaryFrame(command, seq, address, payload=b'', version=PROTOCOL_VERSION):
+    body = bytes([opcode(command, version), seq & 0xFF, len(payload),
+                  (address >> 16) & 0xFF, (address >> 8) & 0xFF, address & 0xFF]) + bytes(payload)
+    return bytes([REQUEST_SYNC]) + body + crc16(body).to_bytes(2, 'big')
+
+
+def binaryReply(status, seq, payload=b''):
+    body = bytes([status, seq & 0xFF, len(payload)]) + bytes(payload)
+    return bytes([REPLY_SYNC]) + body + crc16(body).to_bytes(2, 'big')
+
+
+class Transport:
+    # buffered serial reads: every read takes whatever already arrived, frames
+    # are cut out of the buffer instead of reading the port byte by byte. A
+    # read that gets nothing new for timeout seconds raises ReplyTimeout.
+    def __init__(self, arduino, timeout=REPLY_TIMEOUT):
+        self.arduino = arduino
+        self.timeout = timeout
+        self.buffer = bytearray()
+
+    def fill(self, wanted=1):
+        if self.arduino.timeout != self.timeout:
+            self.arduino.timeout = self.timeout
+        data = self.arduino.read(max(wanted, self.arduino.in_waiting))
+        if not data:
+            raise ReplyTimeout("no reply from arduino")
+        self.buffer += data
+
+    def read(self, count):
+        while len(self.buffer) < count:
+            self.fill(count - len(self.buffer))
+        data = bytes(self.buffer[:count])
+        del self.buffer[:count]
+        return data
+
+    def readUntil(self, delimiter, size=1):
+        # everything up to the delimiter byte, which is dropped; size is the
+        # length expected, so the port is asked for all of it at once
+        start = 0
+        while True:
+            index = self.buffer.find(delimiter, start)
+            if index >= 0:
+                break
+            start = len(self.buffer)
+            self.fill(max(1, size - len(self.buffer)))
+        data = bytes(self.buffer[:index])
+        del self.buffer[:index + 1]
+        return data
+
+    def skipTo(self, value, limit):
+        # drop everything before the next value byte, ProtocolError after limit bytes
+        skipped = 0
+        while True:
+            index = self.buffer.find(value)
+            if index >= 0:
+                skipped += index
+                del self.buffer[:index]
+            else:
+                skipped += len(self.buffer)
+                self.buffer.clear()
+            if skipped > limit:
+                raise ProtocolError("no reply frame from arduino")
+            if index >= 0:
+                return skipped
+            self.fill()
+
+    def discard(self):
+        # anything a command that timed out may still have sent
+        self.buffer.clear()
+        self.arduino.flushInput()
+
+    def drain(self, timeout):
+        # wait until the arduino stayed quiet for timeout seconds
+        saved = self.timeout
+        self.timeout = timeout
+        try:
+            while True:
+                self.fill(0x40)
+                self.buffer.clear()
+        except ReplyTimeout:
+            pass
+        finally:
+            self.timeout = saved
+
+    def write(self, data):
+        self.arduino.write(data)
+
+
+class Link:
+    # what both protocols share: the transport and D and E, which are ASCII
+    # commands for every firmware
+    maxWrite = 0x20
+    maxRead = 0x20
+
+    def __init__(self, arduino, verbose=False, timeout=REPLY_TIMEOUT):
+        self.arduino = arduino
+        self.transport = Transport(arduino, timeout)
+        self.verbose = verbose
+        self.rewrites = 0
+        self.strays = 0
+        self.metrics = Metrics()
+
+    def command(self, frame):
+        if self.verbose:
+            print(bytes(frame).decode('ascii'))
+        self.transport.discard()
+        self.transport.write(frame)
+        return self.metrics.now()
+
+    def acknowledge(self, command, sent):
+        # every reply is read to its end, so the next byte is the K of command
+        answer = self.transport.read(1)
+        if answer != b'K':
+            raise ProtocolError(command + " answered with " + repr(answer))
+        self.metrics.roundTrip(command, self.metrics.now() - sent)
+
+    def configs(self, values):
+        # values is a list of (config index, value)
+        for index, value in values:
+            self.config(index, value)
+
+    def deviceID(self):
+        # DEVID2:DEVID1 with the revision bits cleared, then K
+        sent = self.command(b'DX')
+        answer = self.transport.read(2)
+        self.acknowledge('D', sent)
+        return answer[0] | answer[1] << 8
+
+    def erase(self):
+        sent = self.command(b'EX')
+        self.acknowledge('E', sent)
+
+
+class AsciiLink(Link):
+    binary = False
+    canChecksum = False
+
+    def write(self, address, data, frame=None):
+        sent = self.command(asciiWrite(address, data) if frame is None else frame)
+        self.acknowledge('W', sent)
+
+    def read(self, address, count=0x20):
+        # K R<address, 6 digits><32 bytes, 2 digits each> X CR LF; bytes left
+        # from earlier replies in front of the R are counted and dropped
+        sent = self.command(asciiRead(address))
+        frame = self.transport.readUntil(ord('X'), 2 + 6 + 0x40 + 1)
+        self.transport.read(2)
+        self.metrics.roundTrip('R', self.metrics.now() - sent)
+        if self.verbose:
+            print(frame.decode('ascii', 'replace') + "X")
+
+        start = frame.find(b'R')
+        if start < 1 or frame[:start].strip(STRAY):
+            raise ProtocolError("wrong command received from arduino")
+        self.strays += start - 1
+        try:
+            if int(frame[start + 1:start + 7], 16) != address:
+                raise ProtocolError("read of " + hex(address) + " answered for another address")
+            return bytes.fromhex(frame[start + 7:start + 7 + 2 * count].decode('ascii'))
+        except ValueError:
+            raise ProtocolError("damaged read reply from arduino")
+
+    def config(self, index, value):
+        sent = self.command(asciiConfig(index, value))
+        self.acknowledge('C', sent)
+
+    def matches(self, address, data):
+        return self.read(address, len(data)) == bytes(data)
+
+    def writeBlocks(self, blocks, window=1, frames=None, verify=False):
+        # ASCII acknowledgments carry no sequence number, so this is always stop-and-wait;
+        # frames holds the already encoded frames of a programming plan. With verify
+        # every block is read back after its write, the addresses of blocks that
+        # could not be written are returned.
+        if frames is None:
+            frames = {}
+        failed = []
+        for address, data in blocks:
+            frame = frames.get((address, len(data)))
+            if not verify:
+                self.write(address, data, frame)
+            elif not writeChecked(self, address, data,
+                                  lambda: self.write(address, data, frame)):
+                failed.append(address)
+        return failed
+
+
+class BinaryLink(Link):
+    binary = True
+
+    def __init__(self, arduino, verbose=False, rxBuffer=64, version=PROTOCOL_VERSION,
+                 timeout=REPLY_TIMEOUT):
+        Link.__init__(self, arduino, verbose, timeout)
+        self.rxBuffer = rxBuffer
+        self.version = version
+        self.canChecksum = version >= 2
+        self.maxWrite = self.maxRead = 0x40 if version >= 3 else 0x20
+        self.canVerifyWrite = version >= 4
+        self.canFill = version >= 5
+        self.canBatchConfig = version >= 6
+        self.seq = 0
+        self.retries = 0
+
+    def request(self, command, address, payload=b'', busy=0):
+        # busy is how long the arduino may work before it starts to answer;
+        # a damaged, missing or rejected reply resyncs and sends the request
+        # again with a new seq, up to MAX_RETRIES times
+        for attempt in range(MAX_RETRIES + 1):
+            if attempt:
+                self.retries += 1
+                if self.verbose:
+                    print("resending " + command + " at " + hex(address))
+                self.resync()
+            self.seq = (self.seq + 1) & 0xFF
+            frame = binaryFrame(command, self.seq, address, payload, self.version)
+            if self.verbose:
+                print(frame.hex().upper())
+            self.transport.write(frame)
+            sent = self.metrics.now()
+
+            timeout = self.transport.timeout
+            self.transport.timeout = timeout + busy
+            try:
+                status, seq, data = self.reply()
+            except ProtocolError as msg:
+                error = str(msg)
+                continue
+            finally:
+                self.transport.timeout = timeout
+            if status != ACK:
+                error = "rejected by the arduino"
+            elif seq != self.seq:
+                error = "reply " + str(seq) + " does not match request " + str(self.seq)
+            else:
+                self.metrics.roundTrip(command, self.metrics.now() - sent)
+                return data
+        raise ProtocolError(command + " at " + hex(address) + " failed after "
+                            + str(MAX_RETRIES) + " retries: " + error)
+
+    def resync(self):
+        # a frame that lost its sync byte leaves the firmware collecting an
+        # ASCII command until the next X; end it without running it and drop
+        # everything the arduino still sends, e.g. the replies to frames in flight
+        self.transport.write(RESYNC)
+        self.transport.drain(RESYNC_TIME)
+
+    def reply(self):
+        # skip anything up to the sync byte, e.g. the K of an ASCII command
+        self.strays += self.transport.skipTo(REPLY_SYNC, MAX_PAYLOAD * 2)
+        header = self.transport.read(4)[1:]
+        rest = self.transport.read(header[2] + 2)
+        body = header + rest[:-2]
+        if crc16(body) != int.from_bytes(rest[-2:], 'big'):
+            raise ProtocolError("reply CRC mismatch")
+        if self.verbose:
+            print((bytes([REPLY_SYNC]) + header + rest).hex().upper())
+        return header[0], header[1], rest[:-2]
+
+    def pack(self, command, data):
+        # the command and payload a block of data is written with, F if the
+        # data run-length encoded is shorter
+        if self.canFill:
+            runs = runLength(data)
+            if len(runs) + 1 < len(data):
+                return 'F', bytes([opcode(command, self.version)]) + runs
+        return command, data
+
+    def write(self, address, data):
+        command, payload = self.pack('W', data)
+        self.metrics.payload(len(data), len(payload))
+        self.request(command, address, payload)
+
+    def read(self, address, count=0x20):
+        data = self.request('R', address, bytes([count]))
+        if len(data) != count:
+            raise ProtocolError("short read at " + hex(address))
+        return data
+
+    def config(self, index, value):
+        self.request('C', index, bytes([value]))
+
+    def configs(self, values):
+        # one B frame for all of them
+        if not self.canBatchConfig:
+            return Link.configs(self, values)
+        if values:
+            self.request('B', 0, b''.join(bytes([index, value]) for index, value in values))
+
+    def checksum(self, address, length):
+        return int.from_bytes(self.request('S', address, length.to_bytes(3, 'big'),
+                                           length * CRC_BYTE_TIME), 'big')
+
+    def matches(self, address, data):
+        if self.canChecksum:
+            return self.checksum(address, len(data)) == crc16(data)
+        return self.read(address, len(data)) == bytes(data)
+
+    def send(self, entry, command='W'):
+        # entry is [seq, address, data, frame, tries, sent, rewrites], every transmission
+        # gets a new seq so a late acknowledgment of an earlier copy is never mistaken
+        # for this one
+        entry[4] += 1
+        if entry[4] > MAX_RETRIES + 1:
+            raise ProtocolError(command + " at " + hex(entry[1]) + " failed after "
+                                + str(MAX_RETRIES) + " retries")
+        self.seq = (self.seq + 1) & 0xFF
+        entry[0] = self.seq
+        sent, payload = self.pack(command, entry[2])
+        self.metrics.payload(len(entry[2]), len(payload))
+        entry[3] = binaryFrame(sent, self.seq, entry[1], payload, self.version)
+        if self.verbose:
+            print(entry[3].hex().upper())
+        self.transport.write(entry[3])
+        entry[5] = self.metrics.now()
+
+    def resend(self, pending, retry, start, stop=None):
+        # frames the arduino lost are queued to go out again before any new one
+        if stop is None:
+            stop = len(pending)
+        lost = [pending[i] for i in range(start, stop)]
+        for entry in lost:
+            pending.remove(entry)
+            self.retries += 1
+            if self.verbose:
+                print("resending " + hex(entry[1]))
+        retry.extend(lost)
+
+    def canSend(self, pending, frame, window):
+        # the frame being programmed has left the receive buffer, all others
+        # in flight have to fit into it. With a 64 byte buffer one 41 byte
+        # frame of a 32 byte block waits behind it and 73 byte frames of
+        # 64 byte blocks never do, so larger windows change nothing there
+        if not pending:
+            return True
+        if len(pending) >= window:
+            return False
+        waiting = sum(len(entry[3]) for entry in pending) - len(pending[0][3])
+        return waiting + len(frame) <= self.rxBuffer
+
+    def writeBlocks(self, blocks, window=1, frames=None, verify=False):
+        # sliding window: keep up to window frames in flight and match the
+        # acknowledgments by sequence number. NAKs and timeouts halve the window,
+        # every in-order acknowledgment grows it again by one. With verify every
+        # block is compared right after its write and written again if it reads
+        # back wrong, the addresses of blocks that could not be written are returned.
+        if verify and not self.canVerifyWrite:
+            failed = []
+            for address, data in blocks:
+                if not writeChecked(self, address, data, lambda: self.write(address, data)):
+                    failed.append(address)
+            return failed
+
+        command = 'V' if verify else 'W'
+        failed = []
+        blocks = iter(blocks)
+        pending = deque()
+        retry = deque()
+        limit = window
+        entry = None
+
+        while True:
+            while True:
+                if entry is None and retry:
+                    entry = retry.popleft()
+                if entry is None:
+                    block = next(blocks, None)
+                    if block is None:
+                        break
+                    entry = [0, block[0], bytes(block[1]), b'', 0, 0.0, 0]
+                    sent, payload = self.pack(command, entry[2])
+                    entry[3] = binaryFrame(sent, 0, entry[1], payload, self.version)
+                if not self.canSend(pending, entry[3], limit):
+                    break
+                self.send(entry, command)
+                pending.append(entry)
+                entry = None
+
+            if not pending and entry is None:
+                break
+
+            try:
+                status, seq, payload = self.reply()
+            except ProtocolError:
+                # missing or damaged acknowledgment
+                status, seq, payload = None, None, b''
+
+            index = next((i for i, p in enumerate(pending) if p[0] == seq), None)
+            if status is not None and index is None:
+                # acknowledgment of a frame that was already resent
+                continue
+
+            if status != ACK or index > 0:
+                # a frame got lost or rejected, the firmware may be stuck in
+                # the rest of it: resync, which drops the replies still on
+                # their way, and send everything in flight again before any
+                # new block
+                limit = max(1, limit // 2)
+                self.resync()
+                self.resend(pending, retry, 0)
+                if entry is not None:
+                    retry.append(entry)
+                    entry = None
+                continue
+
+            done = pending[index]
+            self.metrics.roundTrip(command, self.metrics.now() - done[5])
+            del pending[index]
+            if limit < window:
+                limit += 1
+
+            if verify and payload != crc16(done[2]).to_bytes(2, 'big'):
+                # written but reads back wrong, program it again right away
+                if done[6] >= MAX_REWRITES:
+                    failed.append(done[1])
+                    continue
+                done[4] = 0
+                done[6] += 1
+                self.rewrites += 1
+                if self.verbose:
+                    print("rewriting " + hex(done[1]))
+                retry.appendleft(done)
+        return failed
+
+
+def negotiate(arduino, allowBinary=True, timeout=HELLO_TIMEOUT):
+    # Say hello to Arduino once, returns the link to use or None if it did not
+    # answer or the answer was damaged
+    transport = Transport(arduino, timeout)
+    transport.discard()
+    transport.write(b'HBX' if allowBinary else b'HX')
+    try:
+        if transport.read(1) != b'H':
+            return None
+    except ReplyTimeout:
+        return None
+    if not allowBinary:
+        return AsciiLink(arduino)
+    try:
+        marker = transport.read(1)
+    except ReplyTimeout:
+        # older firmware stops after the H
+        return AsciiLink(arduino)
+    try:
+        capabilities = transport.read(2)
+    except ReplyTimeout:
+        return None
+    if marker != b'B' or not capabilities[0] or not capabilities[1]:
+        # a lost or damaged byte, ask again rather than fall back to ASCII
+        return None
+    return BinaryLink(arduino, rxBuffer=capabilities[1], version=capabilities[0])
+
+
+def handshake(arduino, allowBinary=True, timeout=CONNECT_TIMEOUT, now=time.monotonic):
+    # repeat the hello until the firmware runs, returns the link or None after
+    # timeout seconds; link.connectTime is how long the board took to answer
+    started = now()
+    attempts = 0
+    while True:
+        attempts += 1
+        link = negotiate(arduino, allowBinary)
+        if link is not None:
+            break
+        if now() - started >= timeout:
+            return None
+    link.connectTime = now() - started
+
+    if attempts > 1:
+        # a hello sent while the firmware was starting may still be answered
+        link.transport.drain(HELLO_TIMEOUT)
+    return link
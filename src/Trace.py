@@ -0,0 +1,349 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Serial traffic traces, for finding out after the fact why a station is
+# slow. pic_programmer.py --trace records every read and write on the port
+# with nanosecond timestamps; this script cuts the trace into commands,
+# replays them against the emulator and splits the time of every command
+# type into
+#   host       the host not waiting for the port: parsing replies, building
+#              the next frame, up to the moment the command was written
+#   wire       the request and reply bytes at the baud rate
+#   device     what the emulated firmware spends on the command, waiting for
+#              earlier commands included
+#   transport  what is left of the round trip: USB scheduling, OS buffers
+#              and firmware slower than the emulator thinks
+#
+#   ./pic_programmer.py -P /dev/ttyACM0 -i blink.hex --trace station1.trace
+#   ./Trace.py station1.trace station2.trace
+#
+# A trace file starts with MAGIC and HEADER, followed by one RECORD per
+# serial call and the bytes it moved. Times are relative to opening the port.
+
+import getopt
+import struct
+import sys
+import time
+
+from Devices import DEFAULT_DEVICE, byName
+from Emulator import Emulator, PicMemory, VirtualClock
+from Metrics import saveReport
+from Protocol import REQUEST_SYNC, REPLY_SYNC, NAK, PROTOCOL_VERSION, OPCODE_VERSION
+
+MAGIC = b'PICTRACE'
+VERSION = 1
+
+# version, baud rate
+HEADER = struct.Struct('<BI')
+
+# kind, start and duration in ns, number of bytes that follow
+RECORD = struct.Struct('<BQIH')
+
+SENT = 0
+RECEIVED = 1
+FLUSHED = 2
+
+
+class TraceError(Exception):
+    pass
+
+
+class TraceSerial:
+    # records the reads and writes of a pyserial object to a trace file;
+    # everything else is passed through unchanged
+    def __init__(self, serial, fileName, now=time.perf_counter_ns):
+        self.__dict__.update(serial=serial, now=now, output=open(fileName, 'wb'))
+        self.__dict__['started'] = now()
+        self.output.write(MAGIC + HEADER.pack(VERSION, int(serial.baudrate)))
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['serial'], name)
+
+    def __setattr__(self, name, value):
+        if name in ('serial', 'now', 'output', 'started'):
+            self.__dict__[name] = value
+        else:
+            setattr(self.serial, name, value)
+
+    def record(self, kind, start, data=b''):
+        duration = min(self.now() - start, 0xFFFFFFFF)
+        offset = 0
+        while True:
+            chunk = data[offset:offset + 0xFFFF]
+            self.output.write(RECORD.pack(kind, start - self.started, duration, len(chunk)) + chunk)
+            offset += len(chunk)
+            if offset >= len(data):
+                break
+
+    def write(self, data):
+        start = self.now()
+        count = self.serial.write(data)
+        self.record(SENT, start, bytes(data))
+        return count
+
+    def read(self, size=1):
+        start = self.now()
+        data = self.serial.read(size)
+        self.record(RECEIVED, start, data)
+        return data
+
+    def flushInput(self):
+        start = self.now()
+        self.serial.flushInput()
+        self.record(FLUSHED, start)
+
+    reset_input_buffer = flushInput
+
+    def close(self):
+        try:
+            self.serial.close()
+        finally:
+            if not self.output.closed:
+                self.output.close()
+
+
+def readTrace(fileName):
+    # returns the baud rate and a list of (kind, start, end, data) in seconds
+    with open(fileName, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC) or len(data) < len(MAGIC) + HEADER.size:
+        raise TraceError(fileName + " is not a trace file")
+    version, baudrate = HEADER.unpack_from(data, len(MAGIC))
+    if version != VERSION:
+        raise TraceError("%s has trace version %d, this script reads %d" % (fileName, version,
+                                                                             VERSION))
+    records = []
+    offset = len(MAGIC) + HEADER.size
+    while offset < len(data):
+        if offset + RECORD.size > len(data):
+            raise TraceError(fileName + " is truncated")
+        kind, start, duration, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            raise TraceError(fileName + " is truncated")
+        records.append((kind, start / 1e9, (start + duration) / 1e9, data[offset:offset + length]))
+        offset += length
+    return baudrate, records
+
+
+class Exchange:
+    # one request and its reply; times in seconds of the trace
+    def __init__(self, request, sent, host):
+        self.request = request
+        self.sent = sent
+        self.host = host
+        self.reply = b''
+        self.replied = None
+        self.device = 0.0
+        self.binary = request[0] == REQUEST_SYNC
+        if self.binary:
+            self.name = chr(request[1] & 0x7F)
+        else:
+            self.name = chr(request[0]) + " ascii"
+
+
+def takeRequest(buffer):
+    # the next whole request in buffer, None while it is incomplete
+    if buffer[0] == REQUEST_SYNC:
+        end = 9 + buffer[3] if len(buffer) >= 4 else len(buffer) + 1
+    else:
+        end = buffer.find(b'X') + 1 or len(buffer) + 1
+    if end > len(buffer):
+        return None
+    request = bytes(buffer[:end])
+    del buffer[:end]
+    return request
+
+
+def takeReply(buffer):
+    # the next whole binary reply in buffer; bytes before its sync are dropped
+    index = buffer.find(REPLY_SYNC)
+    if index < 0:
+        buffer.clear()
+        return None
+    del buffer[:index]
+    if len(buffer) < 4 or len(buffer) < 6 + buffer[3]:
+        return None
+    reply = bytes(buffer[:6 + buffer[3]])
+    del buffer[:len(reply)]
+    return reply
+
+
+def exchanges(records):
+    # the commands of a trace with their replies. ASCII commands are answered
+    # before the next one is sent, binary replies are matched by sequence
+    # number. The host time of a command is the time spent outside of reads
+    # and writes since the previous command was sent
+    result = []
+    pending = bytearray()
+    received = bytearray()
+    waiting = []
+    ascii = None
+    host = 0.0
+    last = records[0][1] if records else 0.0
+    for kind, start, end, data in records:
+        host += max(0.0, start - last)
+        last = end
+        if kind == SENT:
+            host += end - start
+            ascii = None
+            pending += data
+            while pending:
+                request = takeRequest(pending)
+                if request is None:
+                    break
+                exchange = Exchange(request, end, host)
+                host = 0.0
+                result.append(exchange)
+                if exchange.binary:
+                    waiting.append(exchange)
+                else:
+                    ascii = exchange
+        elif kind == FLUSHED:
+            received.clear()
+        elif ascii is not None:
+            if data:
+                ascii.reply += data
+                ascii.replied = end
+        else:
+            received += data
+            while received:
+                reply = takeReply(received)
+                if reply is None:
+                    break
+                # a resent frame has the seq of the one it replaces
+                for exchange in reversed(waiting):
+                    if exchange.request[2] == reply[2]:
+                        waiting.remove(exchange)
+                        exchange.reply = reply
+                        exchange.replied = end
+                        break
+    return result
+
+
+def replay(commands, baudrate, device=DEFAULT_DEVICE):
+    # send every request to the emulator when it was sent in the trace and
+    # note how long the emulated firmware took to answer it
+    clock = VirtualClock()
+    memory = PicMemory(device.deviceID, device.flashSize, device.eepromSize, device.configMasks)
+    # traces of firmware before OPCODE_VERSION send the commands as plain letters
+    legacy = any(exchange.binary and exchange.request[1] < 0x80 for exchange in commands)
+    emulator = Emulator(memory, baudrate=baudrate, clock=clock,
+                        version=OPCODE_VERSION - 1 if legacy else PROTOCOL_VERSION)
+    byteTime = 10.0 / baudrate
+    for exchange in commands:
+        clock.sleep(exchange.sent - clock.now())
+        count = len(emulator.output)
+        emulator.write(exchange.request)
+        answered = len(emulator.output) - count
+        if answered:
+            exchange.device = max(0.0, emulator.output[-1][0] - emulator.hostFree
+                                  - answered * byteTime)
+
+
+def analyze(fileName, device=DEFAULT_DEVICE):
+    baudrate, records = readTrace(fileName)
+    commands = exchanges(records)
+    replay(commands, baudrate, device)
+    byteTime = 10.0 / baudrate
+
+    rows = {}
+    for exchange in commands:
+        row = rows.get(exchange.name)
+        if row is None:
+            row = rows[exchange.name] = {'count': 0, 'unanswered': 0, 'naks': 0, 'host': 0.0,
+                                         'wire': 0.0, 'device': 0.0, 'transport': 0.0,
+                                         'roundTrip': 0.0}
+        row['count'] += 1
+        row['host'] += exchange.host
+        wire = (len(exchange.request) + len(exchange.reply)) * byteTime
+        row['wire'] += wire
+        if exchange.replied is None:
+            row['unanswered'] += 1
+            continue
+        if exchange.binary and exchange.reply[1] == NAK:
+            row['naks'] += 1
+        roundTrip = exchange.replied - exchange.sent
+        row['roundTrip'] += roundTrip
+        row['device'] += exchange.device
+        row['transport'] += roundTrip - wire - exchange.device
+
+    return {'file': fileName, 'baudrate': baudrate,
+            'seconds': records[-1][2] - records[0][1] if records else 0.0,
+            'sent': sum(len(data) for kind, start, end, data in records if kind == SENT),
+            'received': sum(len(data) for kind, start, end, data in records if kind == RECEIVED),
+            'reading': sum(end - start for kind, start, end, data in records if kind == RECEIVED),
+            'host': sum(exchange.host for exchange in commands),
+            'commands': rows}
+
+
+def printAnalysis(analysis):
+    print("%s: %.3f s at %d baud, %d bytes sent, %d received" % (
+        analysis['file'], analysis['seconds'], analysis['baudrate'], analysis['sent'],
+        analysis['received']))
+    print("  host %.3f s, waiting in reads %.3f s" % (analysis['host'], analysis['reading']))
+    print("  %-8s %6s %9s %9s %9s %12s %9s %5s %5s" % ("command", "count", "host ms", "wire ms",
+                                                       "device ms", "transport ms", "mean ms",
+                                                       "naks", "lost"))
+    for name, row in sorted(analysis['commands'].items()):
+        answered = row['count'] - row['unanswered']
+        print("  %-8s %6d %9.1f %9.1f %9.1f %12.1f %9.3f %5d %5d" % (
+            name, row['count'], row['host'] * 1000, row['wire'] * 1000, row['device'] * 1000,
+            row['transport'] * 1000, row['roundTrip'] * 1000 / answered if answered else 0.0,
+            row['naks'], row['unanswered']))
+
+
+def main():
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], 'hm:j:', ['help', 'mcu=', 'json='])
+    except getopt.GetoptError as msg:
+        print(msg)
+        sys.exit(2)
+
+    device = DEFAULT_DEVICE
+    jsonFile = ""
+    for opt, arg in options:
+        if opt in ('-h', '--help'):
+            print("usage: Trace.py [-m, --mcu name] [-j, --json file or -] trace...")
+            sys.exit(0)
+        elif opt in ('-m', '--mcu'):
+            device = byName(arg)
+            if device is None:
+                print("Unknown MCU " + arg)
+                sys.exit(2)
+        elif opt in ('-j', '--json'):
+            jsonFile = arg
+    if not arguments:
+        print("usage: Trace.py [-m, --mcu name] [-j, --json file or -] trace...")
+        sys.exit(2)
+
+    try:
+        results = [analyze(fileName, device) for fileName in arguments]
+    except (OSError, TraceError) as msg:
+        print(msg)
+        sys.exit(2)
+    if jsonFile:
+        saveReport(results, jsonFile)
+    if jsonFile != '-':
+        for analysis in results:
+            printAnalysis(analysis)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Benchmarks for the hex parser, frame encoding and a whole programming run
+# against the emulator. Every image is synthetic, so runs are comparable
+# between releases; --json writes the results for tracking regressions.
+#
+#   ./benchmark.py                   table of all benchmarks
+#   ./benchmark.py -l 0.004 --json results.json
+
+import getopt
+import io
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from contextlib import redirect_stdout
+
+from Hex import Hex, ID_SIZE, FUSE_SIZE, ID_BASE, FUSE_BASE, EEPROM_BASE
+from Devices import DEFAULT_DEVICE, byName
+from Protocol import negotiate, binaryFrame, asciiWrite, PROTOCOL_VERSION
+from Emulator import Emulator, PicMemory, VirtualClock
+from Metrics import Metrics, MeteredSerial, saveReport
+from Plan import loadPlan
+from Dump import HexWriter
+import pic_programmer
+
+# per transfer, typical for USB serial adapters
+USB_LATENCY = 0.001
+
+# a part with a 64 byte write buffer
+LARGE_DEVICE = byName("18f4620")
+
+# binary protocol, window, verify every block right after writing it, protocol
+# version the firmware claims (None for the current one, 4 has neither F nor B frames)
+PROTOCOLS = ((False, 1, False, None), (True, 1, False, None),
+             (True, pic_programmer.DEFAULT_WINDOW, False, 4),
+             (True, pic_programmer.DEFAULT_WINDOW, False, None),
+             (True, pic_programmer.DEFAULT_WINDOW, True, None))
+
+
+def protocolName(binary, window, interleave, version=None):
+    return "%s-w%d%s%s" % ("binary" if binary else "ascii", window, "-I" if interleave else "",
+                           "" if version is None else "-v%d" % version)
+
+
+def hexImage(regions):
+    # regions is a list of (address, data), 16 bytes per record like most compilers emit
+    text = io.StringIO()
+    writer = HexWriter(text)
+    for address, data in regions:
+        writer.write(address, data)
+    writer.close()
+    return text.getvalue()
+
+
+def randomBytes(rnd, count):
+    return bytes(rnd.randrange(256) for _ in range(count))
+
+
+def fullImage(seed=0, device=DEFAULT_DEVICE):
+    # every byte of flash and EEPROM
+    rnd = random.Random(seed)
+    return hexImage([(0, randomBytes(rnd, device.flashSize)),
+                     (EEPROM_BASE, randomBytes(rnd, device.eepromSize))])
+
+
+def sparseImage(seed=0):
+    # a reset vector and small routines scattered over the flash
+    rnd = random.Random(seed)
+    flashSize = DEFAULT_DEVICE.flashSize
+    return hexImage([(address, randomBytes(rnd, 0x40))
+                     for address in range(0, flashSize, flashSize // 16)])
+
+
+def denseImage(seed=0):
+    # one 8 KB program from address 0, the usual small firmware
+    rnd = random.Random(seed)
+    return hexImage([(0, randomBytes(rnd, 0x2000))])
+
+
+def paddedImage(seed=0):
+    # a bootloader and an application merged into one file with the gap
+    # filled with 0xFF, like srec_cat --fill does
+    rnd = random.Random(seed)
+    bootloader = randomBytes(rnd, 0x800)
+    application = randomBytes(rnd, 0x1800)
+    return hexImage([(0, bootloader + b'\xff' * 0x3800 + application)])
+
+
+def zeroedImage(seed=0):
+    # code followed by zero-initialised tables, 0x00 padding to an aligned
+    # application and NOP sleds, which are zero words on the PIC18
+    rnd = random.Random(seed)
+    regions = []
+    for address in range(0, 0x4000, 0x1000):
+        regions.append((address, randomBytes(rnd, 0x600) + bytes(0xA00)))
+    return hexImage(regions)
+
+
+def eepromImage(seed=0):
+    # little code, every EEPROM byte used for tables
+    rnd = random.Random(seed)
+    return hexImage([(0, randomBytes(rnd, 0x200)),
+                     (EEPROM_BASE, randomBytes(rnd, DEFAULT_DEVICE.eepromSize))])
+
+
+def fuseImage(seed=0):
+    # ID locations and every configuration byte set
+    rnd = random.Random(seed)
+    return hexImage([(0, randomBytes(rnd, 0x200)), (ID_BASE, randomBytes(rnd, ID_SIZE)),
+                     (FUSE_BASE, randomBytes(rnd, FUSE_SIZE))])
+
+
+# name, generator, part it is programmed on
+IMAGES = (("sparse", sparseImage, DEFAULT_DEVICE), ("dense", denseImage, DEFAULT_DEVICE),
+          ("full", fullImage, DEFAULT_DEVICE), ("padded", paddedImage, DEFAULT_DEVICE),
+          ("zeroed", zeroedImage, DEFAULT_DEVICE),
+          ("eeprom", eepromImage, DEFAULT_DEVICE),
+          ("fuses", fuseImage, DEFAULT_DEVICE),
+          ("full64", lambda: fullImage(device=LARGE_DEVICE), LARGE_DEVICE))
+
+
+def benchParse(image, number=20, repeat=5):
+    # seconds per parse and peak memory allocated while parsing
+    fd, fileName = tempfile.mkstemp(suffix='.hex')
+    with os.fdopen(fd, 'w') as f:
+        f.write(image)
+    try:
+        best = min(timeit.repeat(lambda: Hex(fileName), number=number, repeat=repeat))
+        tracemalloc.start()
+        try:
+            Hex(fileName)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    finally:
+        os.remove(fileName)
+    return {'seconds': best / number, 'peakBytes': peak, 'textBytes': len(image)}
+
+
+def benchPlan(image, number=20, repeat=5):
+    # seconds to compile a programming plan and to load it from the cache
+    directory = tempfile.mkdtemp()
+    text = image.encode('ascii')
+    try:
+        start = timeit.default_timer()
+        loadPlan(text, pic_programmer.planLayout, directory=directory)
+        compiled = timeit.default_timer() - start
+        load = lambda: loadPlan(text, pic_programmer.planLayout, directory=directory)
+        best = min(timeit.repeat(load, number=number, repeat=repeat))
+    finally:
+        shutil.rmtree(directory)
+    return {'compileSeconds': compiled, 'loadSeconds': best / number}
+
+
+def benchFrames(number=20000, repeat=5):
+    # frames encoded per second for a 32 byte flash block
+    data = bytes(range(0x20))
+    results = {}
+    for name, encode in (("binary", lambda: binaryFrame('W', 1, 0x1234, data)),
+                         ("ascii", lambda: asciiWrite(0x1234, data))):
+        best = min(timeit.repeat(encode, number=number, repeat=repeat)) / number
+        results[name] = {'framesPerSecond': 1 / best, 'dataBytesPerSecond': len(data) / best}
+    return results
+
+
+def benchProtocol(hexFile, binary, window, latency=USB_LATENCY, device=DEFAULT_DEVICE,
+                  interleave=False, version=None):
+    # erase, program and verify on the emulator, in emulated seconds; ratio
+    # is how much smaller run-length encoding made the write frames
+    clock = VirtualClock()
+    memory = PicMemory(device.deviceID, device.flashSize, device.eepromSize, device.configMasks)
+    emulator = Emulator(memory, binary=binary, latency=latency, clock=clock,
+                        version=PROTOCOL_VERSION if version is None else version)
+    metrics = Metrics(now=clock.now)
+    arduino = MeteredSerial(emulator, metrics)
+    link = negotiate(arduino)
+    link.metrics = metrics
+    start = clock.now()
+    with redirect_stdout(io.StringIO()):
+        result = pic_programmer.flashConnected(link, "emulator", hexFile, window=window,
+                                               interleave=interleave)
+    report = metrics.report()
+    return {'ok': result == 0, 'seconds': clock.now() - start, 'sent': emulator.stats['sent'],
+            'received': emulator.stats['received'], 'ratio': metrics.ratio(),
+            'phases': dict((phase['phase'], phase['seconds']) for phase in report['phases'])}
+
+
+def runAll(latency=USB_LATENCY):
+    results = {'python': platform.python_version(), 'latency': latency,
+               'frames': benchFrames(), 'images': {}}
+    for name, generate, device in IMAGES:
+        image = generate()
+        hexFile = Hex(io.StringIO(image))
+        entry = results['images'][name] = {'parse': benchParse(image), 'plan': benchPlan(image),
+                                           'program': {}}
+        for protocol in PROTOCOLS:
+            binary, window, interleave, version = protocol
+            entry['program'][protocolName(*protocol)] = benchProtocol(
+                hexFile, binary, window, latency, device, interleave, version)
+    return results
+
+
+def printResults(results):
+    print("Frame encoding, 32 byte block:")
+    for name, frames in sorted(results['frames'].items()):
+        print("  %-6s %9.0f frames/s %8.2f MB/s"
+              % (name, frames['framesPerSecond'], frames['dataBytesPerSecond'] / 1e6))
+
+    print("Per image, %.1f ms latency, program and verify in emulated seconds:"
+          % (results['latency'] * 1000))
+    keys = [protocolName(*protocol) for protocol in PROTOCOLS]
+    print("  %-8s %8s %9s %8s %8s" % ("image", "text", "parse ms", "peak KB", "plan ms")
+          + "".join(" %12s" % key for key in keys) + " %6s" % "RLE")
+    for name, entry in results['images'].items():
+        parse = entry['parse']
+        print("  %-8s %8d %9.3f %8.1f %8.3f" % (name, parse['textBytes'], parse['seconds'] * 1000,
+                                                parse['peakBytes'] / 1024,
+                                                entry['plan']['loadSeconds'] * 1000)
+              + "".join(" %11.3f%s" % (entry['program'][key]['seconds'],
+                                      " " if entry['program'][key]['ok'] else "!")
+                        for key in keys)
+              + " %5.2fx" % entry['program'][protocolName(*PROTOCOLS[-2])]['ratio'])
+
+
+def main():
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], 'hl:j:', ['help', 'latency=', 'json='])
+    except getopt.GetoptError as msg:
+        print(msg)
+        sys.exit(2)
+
+    latency = USB_LATENCY
+    jsonFile = ""
+    for opt, arg in options:
+        if opt in ('-h', '--help'):
+            print("usage: benchmark.py [-l latency in seconds] [-j, --json file or -]")
+            sys.exit(0)
+        elif opt in ('-l', '--latency'):
+            latency = float(arg)
+        elif opt in ('-j', '--json'):
+            jsonFile = arg
+
+    results = runAll(latency)
+    if jsonFile:
+        saveReport(results, jsonFile)
+    if jsonFile != '-':
+        printResults(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,14 +16,35 @@ Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stef
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+import re
 import sys
+import io
 import getopt
+import glob
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from serial import *
-from Hex import Hex
+from Hex import Hex, HexError, ID_SIZE, FUSE_SIZE, BLOCK_SIZE, ID_BASE, FUSE_BASE, EEPROM_BASE
+from Devices import DEVICES, DEFAULT_DEVICE, byName, byID
+from ImageCache import ImageCache
+from Protocol import handshake, crc16, ProtocolError, REPLY_TIMEOUT
+from Metrics import Metrics, MeteredSerial, saveReport
+from Plan import loadPlan
+from Dump import HexWriter, BinaryWriter, isBinary, dumpImage
 
-mcus = (["18f2455", 0x1260], ["18f2550", 0x1240], ["18f4455", 0x1202],
-        ["18f4550", 0x1200], ["18f2420", 0x1140], ["18f2520", 0x1100],
-        ["18f4420", 0x10C0], ["18f4520", 0x1080])
+# binary frames in flight while programming
+DEFAULT_WINDOW = 4
+
+# largest region checked with one CRC command
+CHECKSUM_CHUNK = 0x1000
+
+# mismatching address ranges listed per memory region, -v lists all of them;
+# ranges less than RANGE_GAP bytes apart are reported as one
+MAX_RANGES = 8
+RANGE_GAP = 0x10
+
+# a run of differing bytes in the XOR of image and readback
+DIFFERENT = re.compile(b'[^\x00]+')
 
 
 def getOut():
@@ -31,10 +52,667 @@ def getOut():
     sys.exit(2)
 
 
+class Mismatches:
+    # the bytes of one memory region that did not read back as expected,
+    # merged into address ranges [start, end, differing bytes]
+    def __init__(self, name):
+        self.name = name
+        self.ranges = []
+        self.count = 0
+
+    def compare(self, address, expected, data):
+        # true if data equals expected; otherwise the XOR of both buffers is
+        # searched for runs of differing bytes, bytes missing from data differ
+        expected = bytes(expected)
+        data = bytes(data)
+        if expected == data:
+            return True
+        length = min(len(expected), len(data))
+        difference = int.from_bytes(expected[:length], 'big') ^ int.from_bytes(data[:length], 'big')
+        for run in DIFFERENT.finditer(difference.to_bytes(length, 'big')):
+            self.add(address + run.start(), address + run.end())
+        if len(expected) > length:
+            self.add(address + length, address + len(expected))
+        return False
+
+    def add(self, start, end):
+        self.count += end - start
+        if self.ranges and start - self.ranges[-1][1] < RANGE_GAP:
+            self.ranges[-1][1] = end
+            self.ranges[-1][2] += end - start
+        else:
+            self.ranges.append([start, end, end - start])
+
+    def report(self, verbose=False):
+        shown = self.ranges if verbose else self.ranges[:MAX_RANGES]
+        for start, end, count in shown:
+            print("  %s 0x%06X-0x%06X: %d of %d bytes differ" % (self.name, start, end - 1, count,
+                                                                end - start))
+        if len(self.ranges) > len(shown):
+            print("  %s: %d more ranges, -v lists them" % (self.name, len(self.ranges) - len(shown)))
+
+
+def mergeBlocks(blocks, limit):
+    # join consecutive blocks into runs of at most limit bytes
+    start = None
+    data = bytearray()
+    for address, block in blocks:
+        if start is not None and address == start + len(data) and len(data) + len(block) <= limit:
+            data += block
+        else:
+            if start is not None:
+                yield start, bytes(data)
+            start, data = address, bytearray(block)
+    if start is not None:
+        yield start, bytes(data)
+
+
+def expectedCRC(hexFile, address, data):
+    # a programming plan knows the CRCs already
+    crc = hexFile.crcs.get((address, len(data)))
+    return crc16(data) if crc is None else crc
+
+
+def readBack(link, address, length):
+    # length bytes from address, in reads as large as the link takes
+    data = bytearray()
+    for offset in range(0, length, link.maxRead):
+        data += link.read(address + offset, min(link.maxRead, length - offset))
+    return data
+
+
+def verifyBlocks(link, blocks, hexFile, mismatches):
+    # runs of consecutive blocks are read back into one buffer and compared
+    # at once; with a CRC computed by the arduino only runs that differ are read
+    verification = 1
+    for address, data in mergeBlocks(blocks, CHECKSUM_CHUNK):
+        if link.canChecksum and \
+                link.checksum(address, len(data)) == expectedCRC(hexFile, address, data):
+            continue
+        if not mismatches.compare(address, data, readBack(link, address, len(data))):
+            verification = 0
+    return verification
+
+
+def flashBlocks(hexFile, size=BLOCK_SIZE, skipBlank=True):
+    # blocks of size bytes holding data, padded with 0xFF; blocks that are
+    # all 0xFF are left out unless skipBlank is false, the bulk erase leaves
+    # them that way already
+    if not skipBlank:
+        for address in range(0, hexFile.havememory.bit_length() * BLOCK_SIZE, size):
+            if hexFile.haveData(address, size):
+                yield address, hexFile.getBlock(address, size)
+        return
+    covered = 0
+    for start, end in hexFile.segments():
+        for address in range(max(start - start % size, covered), end, size):
+            yield address, hexFile.getBlock(address, size)
+            covered = address + size
+
+
+def eepromBlocks(hexFile, skipBlank=True):
+    if not skipBlank:
+        for address in range(0, hexFile.haveeeprom.bit_length() * BLOCK_SIZE, BLOCK_SIZE):
+            if hexFile.haveEEPROM(address):
+                yield address + EEPROM_BASE, hexFile.getEEPROMBlock(address)
+        return
+    for start, end in hexFile.segments(eeprom=True):
+        for address in range(start, end, BLOCK_SIZE):
+            yield address + EEPROM_BASE, hexFile.getEEPROMBlock(address)
+
+
+def imageMatches(link, hexFile, blocks):
+    # true if the blocks on the chip equal the image, nothing is printed
+    for address, data in mergeBlocks(blocks, CHECKSUM_CHUNK):
+        if link.canChecksum:
+            if link.checksum(address, len(data)) != expectedCRC(hexFile, address, data):
+                return False
+        elif readBack(link, address, len(data)) != data:
+            return False
+    return True
+
+
+def expectedFlash(hexFile, device=DEFAULT_DEVICE):
+    # all of the flash as programming the image leaves it, the erase sets
+    # what the image does not cover to 0xFF
+    data = bytes(hexFile.getBlock(0, device.flashSize))
+    return data + b'\xff' * (device.flashSize - len(data))
+
+
+def expectedEEPROM(hexFile, device=DEFAULT_DEVICE):
+    # all of the EEPROM as programming the image leaves it; Hex fills the
+    # bytes of a block the records leave out with 0x00, the erased chip
+    # holds 0xFF outside the written blocks
+    data = bytearray(b'\xff') * device.eepromSize
+    for address, block in eepromBlocks(hexFile, skipBlank=False):
+        address -= EEPROM_BASE
+        data[address:address + len(block)] = block[:device.eepromSize - address]
+    return bytes(data)
+
+
+def planLayout(hexFile):
+    # what a programming plan precomputes: the ASCII frames, which always
+    # hold BLOCK_SIZE bytes, and every region a CRC is asked for
+    blocks = list(flashBlocks(hexFile)) + list(eepromBlocks(hexFile))
+    if hexFile.haveID():
+        blocks.append((ID_BASE, hexFile.id))
+    regions = list(mergeBlocks(flashBlocks(hexFile), CHECKSUM_CHUNK))
+    regions += mergeBlocks(eepromBlocks(hexFile), CHECKSUM_CHUNK)
+    return blocks, regions
+
+
+def loadImage(fileName, device=None):
+    # the programming plan of a hex file, '-' reads stdin
+    if fileName == '-':
+        text = sys.stdin.buffer.read()
+    else:
+        with open(fileName, 'rb') as f:
+            text = f.read()
+    return loadPlan(text, planLayout, device)
+
+
+def fuseMasks(hexFile, device=DEFAULT_DEVICE):
+    # the bits to compare: the implemented bits of the bytes the image sets
+    masks = device.configMasks
+    return bytes(masks[i] if hexFile.fuseChanged(i) and i < len(masks) else 0
+                 for i in range(FUSE_SIZE))
+
+
+def masked(data, masks):
+    return bytes(value & mask for value, mask in zip(data, masks))
+
+
+def chipHoldsImage(link, hexFile, quick=False, device=DEFAULT_DEVICE):
+    # the chip is not erased first, so all of flash and EEPROM is compared and
+    # whatever the image leaves out has to be 0xFF. quick: the image was
+    # flashed on this port before, a single CRC per memory replaces the
+    # comparison in CHECKSUM_CHUNK runs. The cache does not know which board
+    # is connected, so the ID and configuration are compared either way.
+    memories = [(0, expectedFlash(hexFile, device))]
+    if device.eepromSize:
+        memories.append((EEPROM_BASE, expectedEEPROM(hexFile, device)))
+    for start, data in memories:
+        if quick and link.canChecksum:
+            if link.checksum(start, len(data)) != crc16(data):
+                return False
+        elif not imageMatches(link, hexFile, [(start + offset, data[offset:offset + BLOCK_SIZE])
+                                              for offset in range(0, len(data), BLOCK_SIZE)]):
+            return False
+    expected = bytes(hexFile.id) if hexFile.haveID() else b'\xff' * ID_SIZE
+    if link.read(ID_BASE, ID_SIZE) != expected:
+        return False
+    masks = fuseMasks(hexFile, device)
+    return masked(link.read(FUSE_BASE, FUSE_SIZE), masks) == masked(hexFile.fuseValue, masks)
+
+
+def program(link, hexFile, verbose=False, extraVerbose=False, window=DEFAULT_WINDOW,
+            device=DEFAULT_DEVICE, interleave=False, regions=None):
+    # interleave verifies every block right after writing it instead of
+    # reading everything back in a second pass; see verifyImage for regions,
+    # the configuration bits are verified either way
+    if interleave:
+        result = writeImage(link, hexFile, verbose, window, device, verify=True)
+    else:
+        writeImage(link, hexFile, verbose, window, device)
+        result = verifyImage(link, hexFile, verbose, regions, device)
+    writeFuses(link, hexFile, verbose, extraVerbose)
+    result &= verifyFuses(link, hexFile, device, verbose, regions)
+    return result
+
+
+def writeResult(failed, verbose=False):
+    # prints the outcome of a write, 1 if every block was written
+    if not failed:
+        print("\tSuccess")
+        return 1
+    print("\tFailed")
+    if verbose:
+        for address in sorted(failed):
+            print("block at " + hex(address) + " does not read back as written")
+    return 0
+
+
+def writeImage(link, hexFile, verbose=False, window=DEFAULT_WINDOW, device=DEFAULT_DEVICE,
+               verify=False):
+    # Program Memory, in blocks as large as the write buffer of the part if
+    # the firmware takes them; with verify blocks that read back wrong are
+    # written again and the result tells if all of them made it
+    result = 1
+    print("Programming flash memory...", end = '')
+    if verbose:
+        print("\n")
+    size = min(device.writeBlock, link.maxWrite)
+    with link.metrics.phase("flash write"):
+        failed = link.writeBlocks(flashBlocks(hexFile, size), window, hexFile.frames, verify)
+    result &= writeResult(failed, verbose)
+
+    # Program IDs
+    if hexFile.haveID():
+        print("Programming ID memory...", end = '')
+        if verbose:
+            print("\n")
+        # ID 0x200000 - 0x200007
+        with link.metrics.phase("ID write"):
+            failed = link.writeBlocks([(ID_BASE, hexFile.id)], window, hexFile.frames, verify)
+        result &= writeResult(failed, verbose)
+
+    # Program Data EE, on the parts that have it
+    if not device.eepromSize:
+        return result
+    print("Programming EEPROM......", end = '')
+    if verbose:
+        print("\n")
+    # EEPROM 0xF00000 - 0xF00000 + eepromSize
+    with link.metrics.phase("EEPROM write"):
+        failed = link.writeBlocks(eepromBlocks(hexFile), window, hexFile.frames, verify)
+    result &= writeResult(failed, verbose)
+    return result
+
+
+def verifyResult(verification, mismatches, verbose=False):
+    # prints the outcome of a verification and the ranges that differ
+    if verification == 0:
+        print("\tFailed")
+        mismatches.report(verbose)
+    else:
+        print("\tSuccess")
+    return verification
+
+
+def verifyImage(link, hexFile, verbose=False, regions=None, device=DEFAULT_DEVICE):
+    # the Mismatches of flash, ID and EEPROM are added to the list regions
+    result = 1
+    checked = (Mismatches("flash"), Mismatches("ID"), Mismatches("EEPROM"))
+    flash, ids, eeprom = checked
+    if regions is not None:
+        regions += checked
+
+    # verify Program
+    print("Verify flash memory.....", end = '')
+    if verbose:
+        print("\n")
+    with link.metrics.phase("flash verify"):
+        verification = verifyBlocks(link, flashBlocks(hexFile), hexFile, flash)
+    result &= verifyResult(verification, flash, verbose)
+
+    # verify IDs
+    print("Verify ID memory........", end = '')
+    verification = 1
+    if verbose:
+        print("\n")
+    if hexFile.haveID():
+        with link.metrics.phase("ID verify"):
+            data = link.read(ID_BASE, ID_SIZE)
+        verification = int(ids.compare(ID_BASE, hexFile.id, data))
+    result &= verifyResult(verification, ids, verbose)
+
+    # verify EEPROM Data
+    if device.eepromSize:
+        print("Verify EEPROM memory....", end = '')
+        if verbose:
+            print("\n")
+        with link.metrics.phase("EEPROM verify"):
+            verification = verifyBlocks(link, eepromBlocks(hexFile), hexFile, eeprom)
+        result &= verifyResult(verification, eeprom, verbose)
+
+    if result == 0:
+        print("Verification failed: %d bytes differ in %d ranges (%s)" % (
+            sum(region.count for region in checked), sum(len(region.ranges) for region in checked),
+            ", ".join("%s %d" % (region.name, region.count) for region in checked)))
+    return result
+
+
+def writeFuses(link, hexFile, verbose=False, extraVerbose=False):
+    # program configuration bits
+    print("Programming the fuse bits...", end = '')
+    if verbose:
+        print("\n")
+    values = []
+    for i in range(FUSE_SIZE):
+        if hexFile.fuseChanged(i):
+            if extraVerbose:
+                print("fuse "+str(hex(i))+
+                      " changed to "+str(hex(hexFile.getFuse(i))))
+            values.append((i, hexFile.getFuse(i)))
+    # all of them in one frame if the firmware takes it
+    with link.metrics.phase("fuses"):
+        link.configs(values)
+
+    print("\tSuccess")
+
+
+def verifyFuses(link, hexFile, device=DEFAULT_DEVICE, verbose=False, regions=None):
+    # the configuration bytes the image sets, read back at once; bits the
+    # part does not implement read as 0 and are left out. The Mismatches are
+    # added to regions
+    masks = fuseMasks(hexFile, device)
+    if not any(masks):
+        return 1
+    config = Mismatches("config")
+    if regions is not None:
+        regions.append(config)
+
+    print("Verify fuse bits........", end = '')
+    if verbose:
+        print("\n")
+    with link.metrics.phase("fuse verify"):
+        data = link.read(FUSE_BASE, FUSE_SIZE)
+    verification = int(config.compare(FUSE_BASE, masked(hexFile.fuseValue, masks),
+                                      masked(data, masks)))
+    return verifyResult(verification, config, verbose)
+
+
+def flashChip(port, hexFile, mcu="", eraseMode=False, asciiMode=False, window=DEFAULT_WINDOW,
+              skipUnchanged=False, noReset=False, verbose=False, extraVerbose=False,
+              metrics=None, interleave=False, timeout=REPLY_TIMEOUT, trace=""):
+    # erase and program one chip, returns the exit code: 0 success,
+    # 1 chip or verification failure, 2 no connection
+    return withArduino(port, asciiMode, noReset, verbose, metrics, timeout,
+                       lambda link: flashConnected(link, port, hexFile, mcu, eraseMode, window,
+                                                   skipUnchanged, verbose, extraVerbose,
+                                                   interleave), trace)
+
+
+def dumpChip(port, fileName, mcu="", asciiMode=False, noReset=False, verbose=False,
+             metrics=None, output=None, timeout=REPLY_TIMEOUT, trace=""):
+    # read one chip into fileName, exit codes as for flashChip
+    return withArduino(port, asciiMode, noReset, verbose, metrics, timeout,
+                       lambda link: dumpConnected(link, fileName, mcu, output), trace)
+
+
+def withArduino(port, asciiMode, noReset, verbose, metrics, timeout, job, trace=""):
+    # open the port, say hello and run job(link), which returns the exit code;
+    # the serial traffic is recorded to the file trace if given
+    if metrics is None:
+        metrics = Metrics()
+    print("Connecting to arduino...", end = '')
+
+    # Open Serial port
+    try:
+        with metrics.phase("open port"):
+            arduino = openArduino(port, noReset, metrics, trace)
+    except (SerialException, OSError) as msg:
+        print(msg)
+        return 2
+
+    try:
+        with metrics.phase("connect"):
+            link = connect(arduino, asciiMode, verbose, metrics, timeout)
+        if link is None:
+            return 2
+        return job(link)
+    except ProtocolError as msg:
+        print("abort; " + str(msg))
+        return 1
+    finally:
+        arduino.close()
+
+
+def openArduino(port, noReset=False, metrics=None, trace=""):
+    # noReset keeps DTR low, so the auto-reset circuit leaves a running
+    # firmware alone; boards wired differently still reset and are waited for.
+    # With metrics the bytes going through the port are counted, with trace
+    # every read and write is recorded to that file, see Trace.py.
+    arduino = Serial()
+    arduino.port = port
+    arduino.baudrate = 2000000
+    if noReset:
+        arduino.dtr = False
+        arduino.rts = False
+    arduino.open()
+    if trace:
+        from Trace import TraceSerial
+        try:
+            arduino = TraceSerial(arduino, trace)
+        except OSError:
+            arduino.close()
+            raise
+    return arduino if metrics is None else MeteredSerial(arduino, metrics)
+
+
+def connect(arduino, asciiMode=False, verbose=False, metrics=None, timeout=REPLY_TIMEOUT):
+    # Say hello to Arduino until the firmware answers; a reply that stalls
+    # for timeout seconds aborts the command
+    link = handshake(arduino, allowBinary=not asciiMode)
+    if link is None:
+        print("Couldn't connect to the Arduino.")
+        return None
+    link.verbose = verbose
+    link.transport.timeout = timeout
+    if metrics is not None:
+        link.metrics = metrics
+    print("\tSuccess" + ("" if link.binary else " (ASCII protocol)"))
+    if verbose:
+        print("Arduino answered after %.2f s" % link.connectTime)
+        if not asciiMode and not link.binary:
+            print("The firmware stopped after H, it predates the binary protocol")
+    return link
+
+
+def readDeviceID(link):
+    # asking Arduino for the DeviceID
+    return link.deviceID()
+
+
+def eraseChip(link):
+    try:
+        link.erase()
+    except ProtocolError as msg:
+        if link.verbose:
+            print(msg)
+        return False
+    return True
+
+
+def findDevice(link, mcu=""):
+    # the Device connected, None if it is not supported
+    metrics = link.metrics
+    print("Connecting to the mcu...", end = '')
+
+    # do not probe for MCU if specified on commandline
+    if mcu != "":
+        device = byName(mcu)
+        if device is None:
+            print("\tUnknown MCU: " + mcu)
+            return None
+        print("\tSelected MCU: " + device.name)
+        return device
+
+    with metrics.phase("device ID"):
+        deviceID = readDeviceID(link)
+    device = byID(deviceID)
+    if device is not None:
+        print("\tYour MCU: " + device.name)
+        return device
+
+    print("MCU not recognized. Check the list of compatible MCU'S \
+        and/or check your wire conections.")
+    return None
+
+
+def flashConnected(link, port, hexFile, mcu="", eraseMode=False, window=DEFAULT_WINDOW,
+                   skipUnchanged=False, verbose=False, extraVerbose=False, interleave=False):
+    # everything after the handshake, also used by the session daemon
+    metrics = link.metrics
+    device = findDevice(link, mcu)
+    if device is None:
+        return 1
+    if not eraseMode:
+        error = hexFile.fits(device)
+        if error is not None:
+            print("Hex file does not fit the " + device.name + ": " + error)
+            return 1
+
+    if skipUnchanged and not eraseMode:
+        cache = ImageCache()
+        digest = hexFile.digest()
+        quick = cache.get(port, device.name) == digest
+        print("Comparing chip to image...", end = '')
+        with metrics.phase("compare"):
+            unchanged = chipHoldsImage(link, hexFile, quick, device)
+        if unchanged:
+            print("\tUnchanged, skipping erase and programming")
+            cache.put(port, device.name, digest)
+            return 0
+        print("\tChanged")
+        cache.forget(port, device.name)
+
+    # Perform Bulk Erase
+    print("Erasing chip............", end = '')
+    with metrics.phase("erase"):
+        erased = eraseChip(link)
+    if not erased:
+        print("Couldn't erase the chip.")
+        return 1
+    print("\tSuccess")
+
+    if eraseMode:
+        return 0
+
+    result = program(link, hexFile, verbose, extraVerbose, window, device, interleave)
+    if verbose and metrics.ratio() > 1:
+        print("Run-length encoding sent %d block bytes as %d, %.2f:1"
+              % (metrics.blockBytes, metrics.payloadBytes, metrics.ratio()))
+    if skipUnchanged and result:
+        cache.put(port, device.name, digest)
+    return 0 if result else 1
+
+
+def dumpConnected(link, fileName, mcu="", output=None, binary=None):
+    # everything after the handshake, also used by the session daemon; the
+    # chip goes to a raw binary file if the name ends in .bin or binary is
+    # true, else to Intel HEX. An open output, e.g. stdout, is written to
+    # instead of fileName.
+    metrics = link.metrics
+    device = findDevice(link, mcu)
+    if device is None:
+        return 1
+    if binary is None:
+        binary = isBinary(fileName)
+    if output is None:
+        try:
+            stream = open(fileName, 'wb' if binary else 'w')
+        except OSError as msg:
+            print("Can not write the dump: " + str(msg))
+            return 2
+    else:
+        stream = output
+    try:
+        writer = BinaryWriter(stream) if binary else HexWriter(stream)
+        start = metrics.now()
+        count = dumpImage(link, device, writer, link.verbose)
+        seconds = metrics.now() - start
+    finally:
+        if output is None:
+            stream.close()
+    print("Read %d bytes in %.2f s, %.0f bytes/s"
+          % (count, seconds, count / seconds if seconds > 0 else 0))
+    return 0
+
+
+class ThreadOutput:
+    # stdout replacement handing the whole lines printed by a thread to the
+    # sink that thread registered, used by gang mode and the session daemon
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def start(self, sink):
+        self.local.sink = sink
+        self.local.line = ""
+
+    def write(self, text):
+        sink = getattr(self.local, 'sink', None)
+        if sink is None:
+            with self.lock:
+                return self.stdout.write(text)
+        self.local.line += text
+        lines = self.local.line.split("\n")
+        self.local.line = lines.pop()
+        for line in lines:
+            if line.strip():
+                sink(line)
+        return len(text)
+
+    def finish(self):
+        if self.local.line.strip():
+            self.local.sink(self.local.line)
+        self.local.sink = None
+
+    def flush(self):
+        with self.lock:
+            self.stdout.flush()
+
+
+def expandPorts(spec):
+    # comma separated list of ports and globs like /dev/ttyACM*
+    ports = []
+    for pattern in spec.split(","):
+        pattern = pattern.strip()
+        if pattern == "":
+            continue
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for port in matches:
+            if port not in ports:
+                ports.append(port)
+    return ports
+
+
+def gangProgram(spec, hexFile, metricsJson="", **settings):
+    # program the same, already parsed image on every port at once;
+    # a failing station does not stop the others
+    ports = expandPorts(spec)
+    if not ports:
+        print("No serial port matches " + spec)
+        return 2
+    metrics = dict((port, Metrics()) for port in ports)
+
+    stdout = sys.stdout
+    output = ThreadOutput(stdout)
+
+    def station(port):
+        def sink(line):
+            with output.lock:
+                stdout.write("[" + port + "] " + line + "\n")
+                stdout.flush()
+
+        output.start(sink)
+        try:
+            return flashChip(port, hexFile, metrics=metrics[port], **settings)
+        except Exception as msg:
+            print("abort; " + str(msg))
+            return 1
+        finally:
+            output.finish()
+
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+            results = list(pool.map(station, ports))
+    finally:
+        sys.stdout = stdout
+
+    print("Gang results:")
+    for port, result in zip(ports, results):
+        print("  " + port.ljust(20) + ("PASS" if result == 0 else "FAIL"))
+    print(str(results.count(0)) + " of " + str(len(ports)) + " passed")
+    if metricsJson:
+        saveReport({'stations': dict((port, metrics[port].finish()) for port in ports)},
+                   metricsJson)
+    return 0 if all(result == 0 for result in results) else 1
+
+
 def main():
     try:
         options, arguments = getopt.getopt(sys.argv[1:],
-                                           'hp:aP:i:levV', ['help', 'port=', 'list', 'erase'])
+                                           'hp:aP:i:levVw:sg:SnId:', ['help', 'port=', 'list',
+                                                                      'erase', 'ascii', 'window=',
+                                                                      'skip-unchanged', 'gang=',
+                                                                      'session=', 'no-reset',
+                                                                      'metrics-json=', 'interleave',
+                                                                      'dump=', 'timeout=',
+                                                                      'trace='])
     except getopt.GetoptError as msg:
         print(msg)
         getOut()
@@ -43,6 +721,17 @@ def main():
     PORT = ""
     FILENAME = ""
     ERASE_MODE = False
+    ASCII_MODE = False
+    WINDOW = DEFAULT_WINDOW
+    SKIP_UNCHANGED = False
+    GANG = ""
+    SESSION = ""
+    NO_RESET = False
+    METRICS_JSON = ""
+    INTERLEAVE = False
+    DUMP = ""
+    TIMEOUT = REPLY_TIMEOUT
+    TRACE = ""
     verbose = False
     extraVerbose = False
 
@@ -52,16 +741,53 @@ def main():
             print(helpFile.read() + "\n")
             sys.exit(0)
         elif opt in ('-l', '--list'):
-            print("Supported MCUs:")
-            for mcu, i in mcus:
-                print("pic" + mcu)
+            print("Supported MCUs:      flash  EEPROM  write block")
+            for device in DEVICES:
+                print("pic%-12s %6d  %6d  %11d" % (device.name, device.flashSize,
+                                                   device.eepromSize, device.writeBlock))
             sys.exit(0)
         elif opt in ('-e', '--erase'):
             ERASE_MODE = True
+        elif opt in ('-a', '--ascii'):
+            ASCII_MODE = True
+        elif opt in ('-w', '--window'):
+            try:
+                WINDOW = int(arg)
+            except ValueError:
+                WINDOW = 0
+            if WINDOW < 1:
+                print("The window needs to be a positive number")
+                getOut()
+        elif opt in ('-s', '--skip-unchanged'):
+            SKIP_UNCHANGED = True
+        elif opt in ('-n', '--no-reset'):
+            NO_RESET = True
+        elif opt in ('-I', '--interleave'):
+            INTERLEAVE = True
+        elif opt in ('-d', '--dump'):
+            DUMP = arg
+        elif opt == '--timeout':
+            try:
+                TIMEOUT = float(arg)
+            except ValueError:
+                TIMEOUT = 0
+            if TIMEOUT <= 0:
+                print("The timeout needs to be a positive number of seconds")
+                getOut()
+        elif opt == '--metrics-json':
+            METRICS_JSON = arg
+        elif opt == '--trace':
+            TRACE = arg
         elif opt in ('-p'):
             MCU = arg
         elif opt in ('-P', '--port'):
             PORT = arg
+        elif opt in ('-g', '--gang'):
+            GANG = arg
+        elif opt == '-S':
+            SESSION = "default"
+        elif opt == '--session':
+            SESSION = arg
         elif opt in ('-i'):
             FILENAME = arg
         elif opt in ('-V'):
@@ -72,311 +798,88 @@ def main():
 
     if PORT == "":
         PORT = '/dev/ttyACM0'
-    if FILENAME == "" and not ERASE_MODE:
+    if FILENAME == "" and not ERASE_MODE and not DUMP:
         print("You need to select an hex file with -i option")
         getOut()
+    device = None
+    if MCU != "":
+        device = byName(MCU)
+        if device is None:
+            print("Unknown MCU " + MCU + ", -l lists the supported ones")
+            getOut()
+
+    if TRACE and (GANG or SESSION):
+        print("--trace records a single port, it can not be combined with -g or -S")
+        getOut()
+    if SESSION and (ASCII_MODE or NO_RESET or TIMEOUT != REPLY_TIMEOUT):
+        print("-a, -n and --timeout are settings of the session daemon, start Daemon.py with them")
+        getOut()
 
-    print("Connecting to arduino...", end = '')
-
-    # Open Serial port
-    try:
-        arduino = Serial(PORT, 2000000)
-    except(SerialException, msg):
-        print(msg)
-        sys.exit(2)
-
-    time.sleep(2)
-
-    # Say hello to Arduino
-    arduino.flushInput()
-    arduino.write('HX'.encode('utf-8'))
-    if arduino.read().decode('utf-8') == 'H':
-        # If Arduino responds, check for the mcu
-        print("\tSuccess")
-        print("Connecting to the mcu...", end = '')
-
-        # checking the MCU
-        mcu_found = False
-
-        # do not probe for MCU if specified on commandline
-        if MCU != "":
-            mcu_found = True
-
-        if not mcu_found:
-            arduino.flushInput()
-            arduino.write('DX'.encode('utf-8'))  # asking Arduino for the DeviceID
-            deviceID = ord(arduino.read().decode('utf-8')) + ord(arduino.read().decode('utf-8')) * 256
-
-            for mcu, ID in mcus:
-                if ID == deviceID:
-                    print("\tYour MCU: " + mcu)
-                    mcu_found = True
-
-        if mcu_found:
-            # Perform Bulk Erase
-            print("Erasing chip............", end = '')
-            arduino.flushInput()
-            arduino.write('EX'.encode('utf-8'))
-            if arduino.read().decode('utf-8') == "K":
-                print("\tSuccess")
-
-                if not ERASE_MODE:
-                    # open and parse the hex file
-                    hexFile = Hex(FILENAME)
-
-                    # Program Memory
-                    print("Programming flash memory...", end = '')
-                    if verbose:
-                        print("\n")
-                    address = 0
-                    while address < 0x8000:
-                        if hexFile.haveData(address):
-                            buf = "W"
-                            buf += str(hex(address)[2:].zfill(4))
-                            for j in range(0x20):
-                                buf += str(hex(hexFile.getData(address + j))[2:].zfill(2))
-                            buf += "X"
-                            if verbose:
-                                print(buf)
-                            arduino.flushInput()
-                            arduino.write(buf.upper().encode('utf-8'))
-                            arduino.read()
-                        address += 0x20
-                    print("\tSuccess")
-
-                    # Program IDs
-                    if hexFile.haveID():
-                        print("Programming ID memory...", end = '')
-                        if verbose:
-                            print("\n")
-                        # ID 0x200000 - 0x200007
-                        address = 0
-
-                        buf = "W"
-                        buf += str(hex(address + 0x200000)[2:].zfill(6))
-                        for j in range(0x8):
-                            buf += str(hex(hexFile.getID(address + j))[2:].zfill(2))
-                        buf += "X"
-                        if verbose:
-                            print(buf)
-                        arduino.flushInput()
-                        arduino.write(buf.upper().encode('utf-8'))
-                        arduino.read()
-                        print("\tSuccess")
-
-                    # Program Data EE
-                    # TODO only some parts have EEPROM
-                    print("Programming EEPROM......", end = '')
-                    if verbose:
-                        print("\n")
-                    # EEPROM 0xF00000 - 0xF00100
-                    address = 0
-                    while address < 0x100:
-                        if hexFile.haveEEPROM(address):
-                            buf = "W"
-                            buf += str(hex(address + 0xF00000)[2:].zfill(6))
-                            for j in range(0x20):
-                                buf += str(hex(hexFile.getEEPROM(address + j))[2:].zfill(2))
-                            buf += "X"
-                            if verbose:
-                                print(buf)
-                            arduino.flushInput()
-                            arduino.write(buf.upper().encode('utf-8'))
-                            arduino.read()
-                        address += 0x20
-
-                    print("\tSuccess")
-
-                    # verify Program
-                    print("Verify flash memory.....", end = '')
-                    verification = 1
-                    if verbose:
-                        print("\n")
-                    address = 0
-                    while address < 0x8000:
-                        if hexFile.haveData(address):
-
-                            # Send read command
-                            buf = "R"
-                            buf += str(hex(address)[2:].zfill(6))
-                            buf += "X"
-                            arduino.flushInput()
-                            arduino.write((buf).upper().encode('utf-8'))
-                            arduino.read()
-
-                            # Receive data
-                            buf = ""
-                            r = arduino.read().decode('utf-8')
-                            while r != "X":
-                                buf += r
-                                r = arduino.read().decode('utf-8')
-                            buf += r
-
-                            if verbose:
-                                print(buf)
-
-                            # Compare
-                            c, buf = buf[:1], buf[1:]
-                            if c != "R":
-                                print("abort; wrong command received from arduino")
-                                return 1
-
-                            iAddress, buf = int(buf[:6], 16), buf[6:]
-                            for j in range(0x20):
-                                data, buf = int(buf[:2], 16), buf[2:]
-                                compare_data = hexFile.getData(iAddress + j)
-                                if compare_data != data:
-                                    print("verification failed "+
-                                          str(hex(compare_data))[2:].zfill(2)+
-                                          " do not match "+str(hex(data))[2:].zfill(2))
-                                    verification = 0
-
-                        address += 0x20
-                    if verification == 0:
-                        print("\tFailed")
-                    else:
-                        print("\tSuccess")
-
-                    # verify IDs
-                    print("Verify ID memory........", end = '')
-                    verification = 1
-                    if verbose:
-                        print("\n")
-                    if hexFile.haveID():
-                        # Send read command
-                        buf = "R"
-                        buf += str(hex(0x200000)[2:].zfill(6))
-                        buf += "X"
-                        arduino.flushInput()
-                        arduino.write((buf).upper().encode('utf-8'))
-                        arduino.read()
-
-                        # Receive data
-                        buf = ""
-                        r = arduino.read().decode('utf-8')
-                        while r != "X":
-                            buf += r
-                            r = arduino.read().decode('utf-8')
-                        buf += r
-
-                        if verbose:
-                            print(buf)
-
-                        # Compare
-                        c = buf[:1]
-                        if c == "K":
-                            #workaround python serial bug... K received twice!
-                            # remove R
-                            buf = buf[1:]
-                            c = buf[:1]
-                        if c != "R":
-                            print("abort; wrong command received from arduino")
-                            return 1
-                        # remove R
-                        buf = buf[1:]
-
-                        iAddress, buf = int(buf[:6], 16), buf[6:]
-                        for j in range(0x8):
-                            data, buf = int(buf[:2], 16), buf[2:]
-                            compare_data = hexFile.getID(iAddress - 0x200000 + j)
-                            if compare_data != data:
-                                print("verification failed "+
-                                      str(hex(compare_data))[2:].zfill(2)+
-                                      " do not match "+str(hex(data))[2:].zfill(2))
-                                verification = 0
-                    if verification == 0:
-                        print("\tFailed")
-                    else:
-                        print("\tSuccess")
-
-                    # verify EEPROM Data
-                    print("Verify EEPROM memory....", end = '')
-                    verification = 1
-                    if verbose:
-                        print("\n")
-                    address = 0
-                    while address < 0x100:
-                        if hexFile.haveEEPROM(address):
-
-                            # Send read command
-                            buf = "R"
-                            buf += str(hex(address + 0xF00000)[2:].zfill(6))
-                            buf += "X"
-                            arduino.flushInput()
-                            arduino.write((buf).upper().encode('utf-8'))
-                            arduino.read()
-
-                            # Receive data
-                            buf = ""
-                            r = arduino.read().decode('utf-8')
-                            while r != "X":
-                                buf += r
-                                r = arduino.read().decode('utf-8')
-                            buf += r
-
-                            if verbose:
-                                print(buf)
-
-                            # Compare
-                            c = buf[:1]
-                            if c == "K":
-                                #workaround python serial bug... K received twice!
-                                # remove R
-                                buf = buf[1:]
-                                c = buf[:1]
-                            if c != "R":
-                                print("abort; wrong command received from arduino")
-                                return 1
-                            # remove R
-                            buf = buf[1:]
-
-                            iAddress, buf = int(buf[:6], 16), buf[6:]
-                            for j in range(0x20):
-                                data, buf = int(buf[:2], 16), buf[2:]
-                                compare_data = hexFile.getEEPROM(iAddress - 0xF00000 + j)
-                                if compare_data != data:
-                                    print("verification failed "+
-                                          str(hex(compare_data))[2:].zfill(2)+
-                                          " do not match "+str(hex(data))[2:].zfill(2))
-                                    verification = 0
-
-                        address += 0x20
-                    if verification == 0:
-                        print("\tFailed")
-                    else:
-                        print("\tSuccess")
-
-                    # program configuration bits
-                    print("Programming the fuse bits...", end = '')
-                    if verbose:
-                        print("\n")
-                    for i in range(0x0F):
-                        if hexFile.fuseChanged(i):
-                            buf = "C" + hex(i)[2:] + hex(hexFile.getFuse(i))[2:].zfill(2) + "X"
-                            if verbose:
-                                if extraVerbose:
-                                    print("fuse "+str(hex(i))+
-                                          " changed to "+str(hex(hexFile.getFuse(i))))
-                                print(buf)
-                            arduino.flushInput()
-                            arduino.write(buf.upper().encode('utf-8'))
-                            arduino.read()
-
-                    print("\tSuccess")
-
-                    # verify configuration bits
-                    # TODO
+    if DUMP:
+        if GANG:
+            print("-d reads a single chip, it can not be combined with -g")
+            getOut()
+        # the HEX goes to stdout, everything else to stderr
+        output = None
+        if DUMP == '-':
+            output = sys.stdout
+            sys.stdout = sys.stderr
+        if SESSION:
+            from Daemon import submit, DEFAULT_ADDRESS
+            job = {'command': 'dump', 'binary': isBinary(DUMP), 'mcu': MCU,
+                   'verbose': verbose, 'metrics': METRICS_JSON != ""}
+            sys.exit(submit(job, DEFAULT_ADDRESS if SESSION == "default" else SESSION,
+                            METRICS_JSON, DUMP, output))
+        metrics = Metrics()
+        result = dumpChip(PORT, DUMP, mcu=MCU, asciiMode=ASCII_MODE, noReset=NO_RESET,
+                          verbose=verbose, metrics=metrics, output=output, timeout=TIMEOUT,
+                          trace=TRACE)
+        if METRICS_JSON:
+            saveReport(metrics.finish(), METRICS_JSON)
+        sys.exit(result)
+
+    # open and parse the hex file before touching the chip
+    hexFile = None
+    hexText = ""
+    if not ERASE_MODE:
+        try:
+            if SESSION:
+                # the daemon gets the text of the file, check it here first
+                if FILENAME == '-':
+                    hexText = sys.stdin.read()
+                else:
+                    with open(FILENAME) as f:
+                        hexText = f.read()
+                hexFile = Hex(io.StringIO(hexText), device)
             else:
-                print("Couldn't erase the chip.")
-                sys.exit(1)
-        else:
-            print("MCU not recognized. Check the list of compatible MCU'S \
-                and/or check your wire conections.")
-            sys.exit(1)
-    else:
-        print("Couldn't connect to the Arduino.")
-        sys.exit(2)
-    arduino.close()
+                hexFile = loadImage(FILENAME, device)
+        except (OSError, HexError) as msg:
+            print("Hex file not valid: " + str(msg))
+            sys.exit(2)
+
+    if SESSION:
+        from Daemon import submit, DEFAULT_ADDRESS
+        job = {'command': 'erase' if ERASE_MODE else 'program', 'hex': hexText, 'mcu': MCU,
+               'window': WINDOW, 'skipUnchanged': SKIP_UNCHANGED, 'verbose': verbose,
+               'extraVerbose': extraVerbose, 'interleave': INTERLEAVE,
+               'metrics': METRICS_JSON != ""}
+        sys.exit(submit(job, DEFAULT_ADDRESS if SESSION == "default" else SESSION, METRICS_JSON))
+
+    if GANG:
+        sys.exit(gangProgram(GANG, hexFile, mcu=MCU, eraseMode=ERASE_MODE,
+                             asciiMode=ASCII_MODE, window=WINDOW,
+                             skipUnchanged=SKIP_UNCHANGED, noReset=NO_RESET,
+                             verbose=verbose, extraVerbose=extraVerbose,
+                             interleave=INTERLEAVE, timeout=TIMEOUT,
+                             metricsJson=METRICS_JSON))
+    metrics = Metrics()
+    result = flashChip(PORT, hexFile, mcu=MCU, eraseMode=ERASE_MODE, asciiMode=ASCII_MODE,
+                       window=WINDOW, skipUnchanged=SKIP_UNCHANGED, noReset=NO_RESET,
+                       verbose=verbose, extraVerbose=extraVerbose, metrics=metrics,
+                       interleave=INTERLEAVE, timeout=TIMEOUT, trace=TRACE)
+    if METRICS_JSON:
+        saveReport(metrics.finish(), METRICS_JSON)
+    sys.exit(result)
 
 
 if __name__ == "__main__":
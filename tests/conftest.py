@@ -0,0 +1,55 @@
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The tests run the programmer against Emulator.py on a virtual clock, so
+# they need neither an Arduino nor a PIC and take no wall clock time for the
+# emulated waits.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from Devices import DEFAULT_DEVICE
+from Emulator import Emulator, PicMemory, VirtualClock
+from Metrics import Metrics, MeteredSerial
+from Protocol import handshake
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    # the image cache of -s and the programming plans stay out of ~/.cache
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def connect():
+    # returns a function saying hello to a new emulated board until it
+    # answers, which gives the link, the PicMemory and the Emulator
+    def connect(binary=True, device=DEFAULT_DEVICE, **settings):
+        clock = VirtualClock()
+        memory = PicMemory(device.deviceID, device.flashSize, device.eepromSize,
+                           device.configMasks)
+        emulator = Emulator(memory, clock=clock, latency=0.001, **settings)
+        metrics = Metrics(now=clock.now)
+        link = handshake(MeteredSerial(emulator, metrics), binary, now=clock.now)
+        link.metrics = metrics
+        return link, memory, emulator
+    return connect
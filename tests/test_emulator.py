@@ -0,0 +1,179 @@
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Programming, verifying and comparing against the emulated board over both
+# protocols, and what the firmware does with frames that lost their sync byte.
+
+import io
+
+import pytest
+
+import benchmark
+import pic_programmer
+from Hex import Hex, EEPROM_BASE, FUSE_BASE
+from Protocol import PROTOCOL_VERSION, AsciiLink, BinaryLink, asciiWrite, binaryFrame, \
+    handshake, negotiate
+
+# binary protocol, firmware version
+LINKS = ((False, PROTOCOL_VERSION), (True, 4), (True, 6), (True, PROTOCOL_VERSION))
+
+
+def image(regions):
+    return Hex(io.StringIO(benchmark.hexImage(regions)))
+
+
+@pytest.fixture(scope='module')
+def dense():
+    return Hex(io.StringIO(benchmark.denseImage()))
+
+
+@pytest.mark.parametrize('binary, version', LINKS)
+@pytest.mark.parametrize('interleave', (False, True))
+def test_program_and_verify(connect, dense, binary, version, interleave):
+    link, memory, emulator = connect(binary=binary, version=version)
+    assert link.binary == binary
+    if binary:
+        assert link.version == version
+    assert pic_programmer.flashConnected(link, "emulator", dense, interleave=interleave) == 0
+    assert bytes(memory.flash) == bytes(dense.memory[:len(memory.flash)])
+    assert pic_programmer.verifyImage(link, dense) == 1
+
+
+@pytest.mark.parametrize('binary', (False, True))
+def test_verify_reports_differences(connect, dense, binary):
+    link, memory, emulator = connect(binary=binary)
+    assert pic_programmer.flashConnected(link, "emulator", dense) == 0
+    memory.programFlash(0x100, b'\x00' * 4)
+    regions = []
+    assert pic_programmer.verifyImage(link, dense, regions=regions) == 0
+    flash = regions[0]
+    assert flash.name == "flash"
+    assert flash.count == sum(1 for value in dense.memory[0x100:0x104] if value)
+
+
+@pytest.mark.parametrize('binary', (False, True))
+def test_skip_unchanged(connect, binary):
+    hexFile = image([(0, bytes(range(64))), (EEPROM_BASE + 0x10, b'\x12' * 8)])
+    link, memory, emulator = connect(binary=binary)
+    erases = lambda: emulator.stats['commands'].get('E', 0)
+
+    assert pic_programmer.flashConnected(link, "emulator", hexFile, skipUnchanged=True) == 0
+    assert erases() == 1
+    assert pic_programmer.flashConnected(link, "emulator", hexFile, skipUnchanged=True) == 0
+    assert erases() == 1
+
+    # data the image leaves out has to be blank as well
+    memory.programFlash(0x7FC0, b'\x00')
+    assert pic_programmer.flashConnected(link, "emulator", hexFile, skipUnchanged=True) == 0
+    assert erases() == 2
+    memory.writeEEPROM(0x80, 0x00)
+    assert pic_programmer.flashConnected(link, "emulator", hexFile, skipUnchanged=True) == 0
+    assert erases() == 3
+    assert memory.readFlash(0x7FC0) == 0xFF
+    assert memory.readEEPROM(0x80) == 0xFF
+
+
+@pytest.mark.parametrize('binary', (False, True))
+def test_fuses_verify_with_masks(connect, binary):
+    # CONFIG1L to CONFIG7H of an 18F4550 with bits set the part does not
+    # implement, which read back as 0
+    fuses = bytes([0xFF, 0xFF, 0xFF, 0x1F, 0xFF, 0x87, 0xC5, 0x00, 0x0F, 0xC0, 0x0F, 0xE0, 0x0F,
+                   0x40])
+    hexFile = image([(0, bytes(range(64))), (FUSE_BASE, fuses)])
+    link, memory, emulator = connect(binary=binary)
+    regions = []
+    assert pic_programmer.program(link, hexFile, regions=regions) == 1
+    assert regions[-1].name == "config" and regions[-1].count == 0
+
+    # an implemented bit that did not take is reported
+    memory.writeConfig(6, 0x80)
+    regions = []
+    assert pic_programmer.verifyFuses(link, hexFile, regions=regions) == 0
+    assert regions[-1].count == 1
+
+
+@pytest.mark.parametrize('garbage', (
+    # a binary W without its sync byte, current and older firmware
+    binaryFrame('W', 1, 0, bytes(range(32)))[1:] + b'X',
+    binaryFrame('W', 1, 0, bytes(range(32)), version=6)[1:] + b'X',
+    # the right length with characters that are no hex digits
+    b'W0000' + b'G0' * 32 + b'X',
+    b'W0000' + b'\x00' * 64 + b'X',
+    b'C0\x00\x00X',
+    b'C00X',
+))
+def test_garbage_leaves_the_part_alone(connect, garbage):
+    link, memory, emulator = connect()
+    config = bytes(memory.config)
+    emulator.write(garbage)
+    assert link.read(0, 0x20) == b'\xff' * 0x20
+    assert bytes(memory.flash) == b'\xff' * len(memory.flash)
+    assert bytes(memory.config) == config
+    assert 'W' not in emulator.stats['commands']
+    assert 'C' not in emulator.stats['commands']
+
+
+def test_ascii_write_still_works(connect):
+    link, memory, emulator = connect()
+    emulator.write(asciiWrite(0, bytes(range(32))))
+    assert link.read(0, 0x20) == bytes(range(32))
+
+
+class Scripted:
+    # a serial port answering every write with the next reply of a list
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.buffer = bytearray()
+        self.timeout = None
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+    def flushInput(self):
+        self.buffer.clear()
+
+    def write(self, data):
+        if self.replies:
+            self.buffer += self.replies.pop(0)
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+@pytest.mark.parametrize('reply', (b'', b'K', b'B\x07\x40', b'H\x07\x40', b'HB\x07', b'HB\x00\x40',
+                                   b'HB\x07\x00'))
+def test_damaged_hello_is_repeated(reply):
+    assert negotiate(Scripted([reply])) is None
+
+
+def test_hello(connect):
+    link = negotiate(Scripted([b'HB\x07\x40']))
+    assert isinstance(link, BinaryLink)
+    assert (link.version, link.rxBuffer) == (7, 0x40)
+    # older firmware stops after the H
+    assert isinstance(negotiate(Scripted([b'H'])), AsciiLink)
+    assert isinstance(connect(binary=True, version=PROTOCOL_VERSION)[0], BinaryLink)
+
+
+def test_handshake_retries_until_the_reply_is_whole():
+    clock = iter(range(100))
+    link = handshake(Scripted([b'HB', b'H\x07\x40', b'HB\x07\x40']), now=lambda: next(clock))
+    assert isinstance(link, BinaryLink)
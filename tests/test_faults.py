@@ -0,0 +1,56 @@
+"""
+Copyright (C) 2012-2020  Kirill Kulakov, Jose Carlos Granja, Xerxes Ranby & Stefan Riesenberger
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Programming a whole chip over a link that loses or damages bytes: every
+# seed has to end with the chip holding the image, never with a frame that
+# lost its sync byte written somewhere as an ASCII command.
+
+import io
+
+import pytest
+
+import benchmark
+import pic_programmer
+from Hex import Hex
+
+SEEDS = range(32)
+
+
+@pytest.fixture(scope='module')
+def image():
+    return Hex(io.StringIO(benchmark.fullImage()))
+
+
+def programWithFaults(connect, image, **faults):
+    link, memory, emulator = connect(**faults)
+    assert link.binary
+    assert pic_programmer.flashConnected(link, "emulator", image) == 0
+    assert bytes(memory.flash) == bytes(image.memory[:len(memory.flash)])
+    assert bytes(memory.eeprom) == bytes(image.eeprom[:len(memory.eeprom)])
+    return link
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_dropped_bytes(connect, image, seed):
+    link = programWithFaults(connect, image, dropRate=1e-3, seed=seed)
+    assert link.retries > 0
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_corrupted_bytes(connect, image, seed):
+    link = programWithFaults(connect, image, corruptRate=1e-3, seed=seed)
+    assert link.retries > 0